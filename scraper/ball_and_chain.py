@@ -5,7 +5,7 @@ import urllib2
 import json
 import base
 import re
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from scraper.util import url_from_arg
 from unidecode import unidecode
 from web.models import Chain, Location
@@ -18,10 +18,18 @@ root_log.setLevel(logging.DEBUG)
 chain = Chain.query.filter_by(name='Ball and Chain').first()
 locations = Location.query.filter_by(chain=chain)
 
+# Menu containers, the rest of the page is never used
+CONTAINER_IDS = ('on_tap_content', 'bottle_list_content')
+CHARSET_PATTERN = re.compile('<meta[^>]+charset=["\']?([\w-]+)')
+
 
 class Scraper(base.Scraper):
-    def __init__(self):
-        pass
+    def __init__(self, restricted=True):
+        """
+        :param restricted: Only parse the menu containers instead of building the full page tree
+        :type restricted: bool
+        """
+        self.restricted = restricted
 
     def scrape(self, html):
         """
@@ -32,11 +40,10 @@ class Scraper(base.Scraper):
         :rtype: ScrapedBeverage[]
         """
         beverages = []
-        # Do a little cleanup to help BeautifulSoup parse correctly
-        html = html.replace('</br />', '<br />')
-        html = html.replace('<img src="images/chain.png" class="chain_rule">',
-                            '<img src="images/chain.png" class="chain_rule" />')
-        parser = BeautifulSoup(html)
+        if self.restricted:
+            parser = parse_containers(html)
+        else:
+            parser = BeautifulSoup(_fix_markup(html), 'lxml')
         beverages += self.scrape_on_tap(parser)
         beverages += self.scrape_bottles(parser)
         return beverages
@@ -111,6 +118,50 @@ class Scraper(base.Scraper):
         return beverages
 
 
+def parse_containers(html):
+    """
+    Parse only the on tap and bottle list containers of a menu page.
+
+    The containers are cut out with a plain search for their opening tags and END comments, so only they are cleaned
+    up and parsed. If either can not be found the whole page is parsed, but only the containers are kept in the tree.
+
+    :param html: Ball and Chain menu web page HTML
+    :type html: str|unicode
+    :return: Parsed containers
+    :rtype: BeautifulSoup
+    """
+    pieces = []
+    head = len(html)
+    for container_id in CONTAINER_IDS:
+        start = html.find('<div id="{0}"'.format(container_id))
+        end = html.find('<!-- END {0} -->'.format(container_id), start)
+        if start == -1 or end == -1:
+            root_log.debug('Unable to find menu container, parsing full page. id={0}'.format(container_id))
+            return BeautifulSoup(html, 'lxml', parse_only=SoupStrainer(id=CONTAINER_IDS))
+        pieces.append(_fix_markup(html[start:end]))
+        head = min(head, start)
+    # The meta tags are cut off along with the rest of the page so pass along the declared charset
+    charset = None
+    if not isinstance(html, unicode):
+        charset = CHARSET_PATTERN.search(html, 0, head)
+        charset = charset.group(1) if charset else None
+    return BeautifulSoup(''.join(pieces), 'lxml', from_encoding=charset)
+
+
+def _fix_markup(html):
+    """
+    Do a little cleanup to help BeautifulSoup parse correctly.
+
+    :param html: Menu HTML
+    :type html: str|unicode
+    :return: Cleaned up HTML
+    :rtype: str|unicode
+    """
+    html = html.replace('</br />', '<br />')
+    return html.replace('<img src="images/chain.png" class="chain_rule">',
+                        '<img src="images/chain.png" class="chain_rule" />')
+
+
 if __name__ == '__main__':
     # Command line arguments
     argparser = argparse.ArgumentParser(description='Scrape')
@@ -0,0 +1,267 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+from collections import OrderedDict
+from datetime import datetime
+from timeit import default_timer
+from scraper import stout, ball_and_chain
+
+root_log = logging.getLogger()
+root_log.setLevel(logging.INFO)
+
+SCRAPER_DIR = os.path.dirname(os.path.abspath(__file__))
+# Menu pages benchmarked for each chain
+STOUT_PAGES = sorted(glob.glob(os.path.join(SCRAPER_DIR, 'sample', '*.html')) +
+                     glob.glob(os.path.join(SCRAPER_DIR, 'test', 'fixtures', 'stout_menu', '*.html')))
+BALL_AND_CHAIN_PAGES = sorted(
+    glob.glob(os.path.join(SCRAPER_DIR, 'sample', 'bandc', '*.html')) +
+    glob.glob(os.path.join(SCRAPER_DIR, 'test', 'fixtures', 'ball_and_chain_menu', '*.html')))
+
+# Timed runs of each stage, the fastest is reported
+DEFAULT_REPEAT = 5
+# Fraction a stage may slow down compared to the baseline before it's flagged as a regression
+DEFAULT_THRESHOLD = 0.1
+
+
+class Stage(object):
+    """
+    A piece of scraper work timed over a set of menu pages.
+    """
+
+    def __init__(self, name, pages, run, inputs=None, reset=None):
+        """
+        :param name:
+        :type name: str
+        :param pages: Paths of the HTML pages the stage works on
+        :type pages: str[]
+        :param run: Does one pass of the work over the inputs
+        :type run: callable
+        :param inputs: Builds the inputs from the page HTML, the pages themselves by default. Not timed.
+        :type inputs: callable
+        :param reset: Called before each timed pass, e.g. to empty a cache. Not timed.
+        :type reset: callable
+        """
+        self.name = name
+        self.pages = pages
+        self.run = run
+        self.inputs = inputs or (lambda pages: pages)
+        self.reset = reset
+
+    def measure(self, repeat=DEFAULT_REPEAT):
+        """
+        Time the stage. There is one untimed warm up pass before the timed ones.
+
+        :param repeat: Number of timed passes
+        :type repeat: int
+        :return: Timing, throughput and peak memory of this process
+        :rtype: dict
+        """
+        html = []
+        for path in self.pages:
+            with open(path) as f:
+                html.append(f.read())
+        inputs = self.inputs(html)
+        self.run(inputs)
+        times = []
+        for i in range(repeat):
+            if self.reset:
+                self.reset()
+            start = default_timer()
+            self.run(inputs)
+            times.append(default_timer() - start)
+        best = min(times)
+        lines = sum(x.count('\n') + 1 for x in inputs)
+        return {
+            'pages': len(html),
+            'lines': lines,
+            'repeat': repeat,
+            'best': best,
+            'mean': sum(times) / len(times),
+            'pages_per_second': len(html) / best if best else None,
+            'lines_per_second': lines / best if best else None,
+            # Kilobytes on Linux
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+
+def _titles(pages):
+    return [title for html in pages for _, _, title in stout.iter_titles(html) if title]
+
+
+def _iter_titles(pages):
+    for html in pages:
+        for _ in stout.iter_titles(html):
+            pass
+
+
+def _parse_menu(streaming):
+    return lambda pages: [stout.parse_menu(html, streaming) for html in pages]
+
+
+def _parse_titles(parse):
+    def run(titles):
+        for title in titles:
+            try:
+                parse(title)
+            except stout.ParsingException:
+                pass
+    return run
+
+
+def _scrape(scraper):
+    return lambda pages: [scraper.scrape(html) for html in pages]
+
+
+_beer_parser = stout.BeerParser()
+stages = OrderedDict((x.name, x) for x in [
+    # Title extraction alone, the streaming pass without any beverage parsing
+    Stage('stout.iter_titles', STOUT_PAGES, _iter_titles),
+    # Full menu with the shared parse cache emptied before each pass
+    Stage('stout.parse_menu', STOUT_PAGES, _parse_menu(True), reset=stout.beer_parser.clear),
+    Stage('stout.parse_menu.cached', STOUT_PAGES, _parse_menu(True)),
+    Stage('stout.parse_menu.tree', STOUT_PAGES, _parse_menu(False), reset=stout.beer_parser.clear),
+    # Beverage strings from every menu, lines are titles
+    Stage('stout.BeerParser.parse', STOUT_PAGES, _parse_titles(_beer_parser.parse), inputs=_titles),
+    Stage('stout.BeerParser.extract', STOUT_PAGES,
+          _parse_titles(lambda x: _beer_parser.extract(_beer_parser.prep(x))), inputs=_titles),
+    Stage('ball_and_chain.scrape', BALL_AND_CHAIN_PAGES, _scrape(ball_and_chain.Scraper())),
+    Stage('ball_and_chain.scrape.full', BALL_AND_CHAIN_PAGES, _scrape(ball_and_chain.Scraper(restricted=False))),
+])
+
+
+def run_stage(name, repeat=DEFAULT_REPEAT):
+    """
+    Measure a stage in a fresh interpreter so the peak memory reported belongs to that stage alone.
+
+    :param name: Stage name
+    :type name: str
+    :param repeat: Number of timed passes
+    :type repeat: int
+    :return: Stage results
+    :rtype: dict
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-m', 'scraper.benchmark', '--child', name, '--repeat', str(repeat)],
+        cwd=os.path.dirname(SCRAPER_DIR))
+    return json.loads(output)
+
+
+def run(names=None, repeat=DEFAULT_REPEAT):
+    """
+    Run the benchmark.
+
+    :param names: Stages to run, all of them by default
+    :type names: str[]
+    :param repeat: Number of timed passes of each stage
+    :type repeat: int
+    :return: Machine readable results
+    :rtype: dict
+    """
+    results = OrderedDict()
+    for name in names or stages:
+        root_log.info('Running {0}'.format(name))
+        results[name] = run_stage(name, repeat)
+    return {
+        'created': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'stages': results,
+    }
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Find stages that got slower than a stored baseline.
+
+    :param results: Results of this run
+    :type results: dict
+    :param baseline: Results of an earlier run
+    :type baseline: dict
+    :param threshold: Fraction a stage may slow down before it's a regression
+    :type threshold: float
+    :return: Name, baseline best time and best time of each regressed stage
+    :rtype: (str, float, float)[]
+    """
+    regressions = []
+    for name, stage in results['stages'].iteritems():
+        before = baseline['stages'].get(name)
+        if before and stage['best'] > before['best'] * (1 + threshold):
+            regressions.append((name, before['best'], stage['best']))
+    return regressions
+
+
+def report(results, baseline=None):
+    """
+    Human readable table of results.
+
+    :param results:
+    :type results: dict
+    :param baseline: Results of an earlier run to show the change against
+    :type baseline: dict
+    :return:
+    :rtype: str
+    """
+    lines = ['{0:<28} {1:>10} {2:>10} {3:>12} {4:>10} {5:>8}'.format(
+        'stage', 'ms/pass', 'pages/s', 'lines/s', 'peak KB', 'change')]
+    for name, stage in results['stages'].iteritems():
+        change = ''
+        before = baseline and baseline['stages'].get(name)
+        if before:
+            change = '{0:+.1%}'.format(stage['best'] / before['best'] - 1)
+        lines.append('{0:<28} {1:>10.2f} {2:>10.1f} {3:>12.0f} {4:>10} {5:>8}'.format(
+            name, stage['best'] * 1000, stage['pages_per_second'], stage['lines_per_second'], stage['peak_rss'],
+            change))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Benchmark the menu parsers over the sample and fixture menus.')
+    parser.add_argument('stages', nargs='*', metavar='stage',
+                        help='stages to run, all by default: {0}'.format(', '.join(stages)))
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='timed passes of each stage')
+    parser.add_argument('--output', type=str, help='write JSON results to this file')
+    parser.add_argument('--compare', type=str, metavar='BASELINE',
+                        help='JSON results of an earlier run, exits with status 1 if any stage got slower')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='fraction a stage may slow down before it is a regression')
+    parser.add_argument('--child', type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    for name in args.stages + filter(None, [args.child]):
+        if name not in stages:
+            parser.error('unknown stage {0}'.format(name))
+
+    if args.child:
+        # Measure a single stage and hand the results back to the parent as JSON, leaving out the scrapers' logging
+        root_log.setLevel(logging.ERROR)
+        print json.dumps(stages[args.child].measure(args.repeat))
+        sys.exit(0)
+
+    # Setup logging
+    sh = logging.StreamHandler(sys.stderr)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+
+    results = run(args.stages, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print report(results, baseline)
+
+    if baseline:
+        regressions = compare(results, baseline, args.threshold)
+        for name, before, after in regressions:
+            root_log.error('Regression in {0}: {1:.2f} ms -> {2:.2f} ms'.format(name, before * 1000, after * 1000))
+        if regressions:
+            sys.exit(1)
@@ -1,18 +1,41 @@
+import argparse
+import hashlib
 import logging
+import threading
 import urllib2
+import urlparse
+import Queue
+from itertools import izip_longest
 import sys
 import stout
 import ball_and_chain
 from datetime import datetime
 from web.models import MenuScrape, Location, BeverageScrape, Beverage, Brewery
 from web import db
+from web.menu_diff import record_menu_changes
 from base import ScrapedBeverage
+from snapshot import snapshots
 
 root_log = logging.getLogger()
 root_log.setLevel(logging.INFO)
 
+# Scraper for each chain name
+scrapers = {
+    'Stout': stout.Scraper,
+    'Ball and Chain': ball_and_chain.Scraper,
+}
 
-def scrape_location(location, scraper):
+# Number of menus downloaded at once
+FETCH_WORKERS = 8
+# Number of menus downloaded at once from a single host
+FETCH_PER_HOST = 2
+# Seconds to wait on a menu download before giving up
+FETCH_TIMEOUT = 30
+# Maximum number of values bound in a single IN clause, SQLite allows 999 parameters per statement
+MAX_QUERY_PARAMS = 500
+
+
+def scrape_location(location, scraper, timeout=FETCH_TIMEOUT):
     """
     Scrape all beverages from a location.
 
@@ -20,23 +43,207 @@ def scrape_location(location, scraper):
     :type location: Location
     :param scraper: Scraper to use
     :type scraper: base.Scraper
+    :param timeout: Seconds to wait on the menu download
+    :type timeout: int
     :return:
     :rtype:
     """
     _log('Scraping {} {} - {}'.format(location.chain.name, location.name, location.url), logging.INFO)
-    menu_scrape = MenuScrape(location=location, url=location.url, created=datetime.now())
-    menu_html = urllib2.urlopen(location.url).read()
-    if menu_html:
-        _log('Read {0} bytes'.format(len(menu_html)), logging.INFO)
+    created = datetime.now()
+    menu = fetch_menu(location.url, timeout, location.menu_etag, location.menu_last_modified)
+    ingest_menu(location, scraper, menu, created)
+    stout.beer_parser.save()
+
+
+def scrape_locations(jobs, workers=FETCH_WORKERS, per_host=FETCH_PER_HOST, timeout=FETCH_TIMEOUT):
+    """
+    Scrape all beverages from many locations at once.
+
+    Menus are downloaded by a bounded pool of threads with at most per_host downloads running against a single host.
+    Parsing and database writes happen on the calling thread as downloads finish, so SQLite only ever has one writer.
+
+    :param jobs: Locations to scrape paired with the Scraper to use
+    :type jobs: (Location, base.Scraper)[]
+    :param workers: Maximum number of concurrent downloads
+    :type workers: int
+    :param per_host: Maximum number of concurrent downloads from a single host
+    :type per_host: int
+    :param timeout: Seconds to wait on each menu download
+    :type timeout: int
+    :return:
+    :rtype:
+    """
+    jobs = list(jobs)
+    if not jobs:
+        return
+    # Everything the download threads need is read here, the ORM session must stay on this thread
+    pending = Queue.Queue()
+    finished = Queue.Queue()
+    host_slots = {}
+    by_host = {}
+    for index, (location, scraper) in enumerate(jobs):
+        host = urlparse.urlparse(location.url).netloc
+        host_slots.setdefault(host, threading.BoundedSemaphore(per_host))
+        by_host.setdefault(host, []).append(
+            (index, location.url, location.menu_etag, location.menu_last_modified, host_slots[host]))
+    # Interleave hosts so queued downloads are not all waiting on the same host
+    for batch in izip_longest(*by_host.values()):
+        for download in batch:
+            if download:
+                pending.put(download)
+    for i in xrange(min(workers, len(jobs))):
+        thread = threading.Thread(target=_fetch_worker, args=(pending, finished, timeout))
+        thread.daemon = True
+        thread.start()
+
+    for i in xrange(len(jobs)):
+        index, created, menu, error = finished.get()
+        location, scraper = jobs[index]
+        _log('Scraping {} {} - {}'.format(location.chain.name, location.name, location.url), logging.INFO)
+        if error:
+            _log('Unable to retrieve menu from {0}. error={1}'.format(location.url, error), logging.ERROR)
+            continue
+        try:
+            ingest_menu(location, scraper, menu, created)
+        except Exception as e:
+            db.session.rollback()
+            _log('Unable to save menu from {0}. error={1}'.format(location.url, e), logging.ERROR)
+        # Parsed values are kept even if the menu was rolled back
+        try:
+            stout.beer_parser.save()
+        except Exception as e:
+            _log('Unable to save parsed values. error={0}'.format(e), logging.ERROR)
+
+
+def _fetch_worker(pending, finished, timeout):
+    """
+    Download menus from the pending queue until it is empty.
+
+    :param pending: Queue of (index, url, etag, last modified, host semaphore)
+    :type pending: Queue.Queue
+    :param finished: Queue receiving (index, created, FetchedMenu, error)
+    :type finished: Queue.Queue
+    :param timeout: Seconds to wait on each download
+    :type timeout: int
+    :return:
+    :rtype:
+    """
+    while True:
+        try:
+            index, url, etag, last_modified, host_slot = pending.get_nowait()
+        except Queue.Empty:
+            return
+        with host_slot:
+            created = datetime.now()
+            try:
+                finished.put((index, created, fetch_menu(url, timeout, etag, last_modified), None))
+            except Exception as e:
+                finished.put((index, created, None, e))
+
+
+class FetchedMenu(object):
+    """
+    Result of a menu download.
+    """
+
+    def __init__(self, html=None, etag=None, last_modified=None, not_modified=False):
+        self.html = html
+        self.etag = etag
+        self.last_modified = last_modified
+        # Server answered 304, html is empty
+        self.not_modified = not_modified
+
+    @property
+    def digest(self):
+        return hashlib.sha1(self.html).hexdigest() if self.html else None
+
+
+def fetch_menu(url, timeout=FETCH_TIMEOUT, etag=None, last_modified=None):
+    """
+    Download menu HTML, sending validators from the previous download so an unchanged menu can be skipped.
+
+    :param url: Menu URL
+    :type url: str
+    :param timeout: Seconds to wait on the download
+    :type timeout: int
+    :param etag: ETag of the previous download
+    :type etag: str
+    :param last_modified: Last-Modified of the previous download
+    :type last_modified: str
+    :return:
+    :rtype: FetchedMenu
+    """
+    request = urllib2.Request(url)
+    if etag:
+        request.add_header('If-None-Match', etag)
+    if last_modified:
+        request.add_header('If-Modified-Since', last_modified)
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as e:
+        if e.code == 304:
+            return FetchedMenu(etag=etag, last_modified=last_modified, not_modified=True)
+        raise
+    return FetchedMenu(response.read(), response.info().getheader('ETag'),
+                       response.info().getheader('Last-Modified'))
+
+
+def ingest_menu(location, scraper, menu, created=None):
+    """
+    Parse a downloaded menu and save a MenuScrape for the location.
+
+    Menus identical to the last one downloaded are not parsed, only the location's menu_checked time is updated.
+
+    :param location: Location the menu belongs to
+    :type location: Location
+    :param scraper: Scraper to use
+    :type scraper: base.Scraper
+    :param menu: Downloaded menu
+    :type menu: FetchedMenu
+    :param created: When the menu was downloaded
+    :type created: datetime
+    :return:
+    :rtype:
+    """
+    created = created or datetime.now()
+    if menu.not_modified or (menu.html and menu.digest == location.menu_digest):
+        _log('Menu unchanged since last scrape of {0}'.format(location.url), logging.INFO)
+        # Same menu, but the server may have sent new validators for it
+        location.menu_etag = menu.etag or location.menu_etag
+        location.menu_last_modified = menu.last_modified or location.menu_last_modified
+        location.menu_checked = created
+        db.session.add(location)
+        db.session.commit()
+    elif menu.html:
+        _log('Read {0} bytes'.format(len(menu.html)), logging.INFO)
+        location.menu_etag = menu.etag
+        location.menu_last_modified = menu.last_modified
+        location.menu_digest = menu.digest
+        location.menu_checked = created
+        menu_scrape = MenuScrape(location=location, url=location.url, created=created,
+                                 html_digest=snapshots.put(menu.html))
         # Flag all existing beverages as inactive
         db.engine.execute('UPDATE beverage SET is_active = 0 WHERE location_id = :location_id', location_id=location.id)
-        update_menu_scrape(menu_scrape, scraper.scrape(menu_html))
+        update_menu_scrape(menu_scrape, scraper.scrape(menu.html))
     else:
         _log('Unable to retrieve menu from {0}'.format(location.url), logging.ERROR)
 
 
+def scraper_for(location):
+    """
+    Get a Scraper for a location based on its chain.
+
+    :param location:
+    :type location: Location
+    :return:
+    :rtype: base.Scraper
+    """
+    return scrapers[location.chain.name]()
+
+
 def update_menu_scrape(menu_scrape, scraped_beverages):
     """
+    Save a scraped menu and log the beverages added and removed since the location's previous menu.
 
     :param menu_scrape:
     :type menu_scrape: MenuScrape
@@ -45,21 +252,91 @@ def update_menu_scrape(menu_scrape, scraped_beverages):
     :return:
     :rtype:
     """
+    beverages = resolve_beverages(scraped_beverages, menu_scrape.location)
     for scraped_beverage in scraped_beverages:
-        brewery = Brewery.query.filter_by(name=scraped_beverage.brewery).first()
-        if not brewery:
-            brewery = Brewery(name=scraped_beverage.brewery, location=scraped_beverage.brewery_location)
-        beverage = Beverage.query.filter_by(name=scraped_beverage.name, brewery=brewery).first()
-        if beverage:
-            beverage = update_beverage(beverage, scraped_beverage)
-            db.session.add(beverage)
+        beverage = beverages[(scraped_beverage.name, scraped_beverage.brewery)]
+        beverage = update_beverage(beverage, scraped_beverage)
+        db.session.add(beverage)
         beverage_scrape = BeverageScrape(beverage=beverage, location=menu_scrape.location, menu_scrape=menu_scrape,
                                          scraped_value=scraped_beverage.scraped_value)
         db.session.add(beverage_scrape)
     db.session.add(menu_scrape)
+    db.session.flush()
+    record_menu_changes(menu_scrape)
     db.session.commit()
 
 
+def resolve_beverages(scraped_beverages, location=None):
+    """
+    Find or create the Beverage for every ScrapedBeverage of a menu.
+
+    Breweries and beverages are looked up with a few IN queries for the whole menu instead of a query per beverage.
+    Any that do not exist yet are created and flushed together. Beverages without a brewery are matched on name alone.
+
+    :param scraped_beverages: Beverages scraped from a menu
+    :type scraped_beverages: ScrapedBeverage[]
+    :param location: Location assigned to newly created beverages
+    :type location: Location
+    :return: Beverages keyed by (name, brewery name)
+    :rtype: dict
+    """
+    keys = set((x.name, x.brewery) for x in scraped_beverages)
+    names = set(name for name, brewery_name in keys)
+    brewery_names = set(brewery_name for name, brewery_name in keys if brewery_name is not None)
+
+    breweries = {}
+    for chunk in _chunks(brewery_names):
+        for brewery in Brewery.query.filter(Brewery.name.in_(chunk)).order_by(Brewery.id):
+            breweries.setdefault(brewery.name, brewery)
+    brewery_names_by_id = dict((x.id, x.name) for x in breweries.values())
+    brewery_names_by_id[None] = None
+
+    beverages = {}
+    for chunk in _chunks(names):
+        for beverage in Beverage.query.filter(Beverage.name.in_(chunk)).order_by(Beverage.id):
+            if beverage.brewery_id in brewery_names_by_id:
+                key = (beverage.name, brewery_names_by_id[beverage.brewery_id])
+                if key in keys:
+                    beverages.setdefault(key, beverage)
+
+    # Create anything we have not seen before
+    created = []
+    for scraped_beverage in scraped_beverages:
+        key = (scraped_beverage.name, scraped_beverage.brewery)
+        if key in beverages:
+            continue
+        brewery = None
+        if scraped_beverage.brewery is not None:
+            brewery = breweries.get(scraped_beverage.brewery)
+            if not brewery:
+                brewery = Brewery(name=scraped_beverage.brewery, location=scraped_beverage.brewery_location)
+                breweries[brewery.name] = brewery
+                created.append(brewery)
+        beverage = Beverage(name=scraped_beverage.name, brewery=brewery, location=location)
+        beverages[key] = beverage
+        created.append(beverage)
+    if created:
+        db.session.add_all(created)
+        db.session.flush()
+    return beverages
+
+
+def _chunks(values, size=MAX_QUERY_PARAMS):
+    """
+    Split values into lists small enough to bind in a single IN clause.
+
+    :param values:
+    :type values: set
+    :param size:
+    :type size: int
+    :return:
+    :rtype: list[]
+    """
+    values = list(values)
+    for i in xrange(0, len(values), size):
+        yield values[i:i + size]
+
+
 def update_beverage(beverage, scraped_beverage):
     """
     Update Beverage with ScrapedBeverage data.
@@ -91,10 +368,26 @@ if __name__ == '__main__':
     sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
     root_log.addHandler(sh)
 
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Scrape beverage menus for all locations.')
+    parser.add_argument('--workers', type=int, default=FETCH_WORKERS, help='number of menus downloaded at once')
+    parser.add_argument('--per-host', type=int, default=FETCH_PER_HOST,
+                        help='number of menus downloaded at once from a single host')
+    parser.add_argument('--timeout', type=int, default=FETCH_TIMEOUT, help='seconds to wait on each menu download')
+    parser.add_argument('--no-parse-cache', action='store_true',
+                        help='do not load or save parsed beverage strings in the database')
+    args = parser.parse_args()
+
+    if not args.no_parse_cache:
+        stout.beer_parser.load()
+
+    jobs = []
     # Stout
     for loc in stout.locations:
-        scrape_location(loc, stout.Scraper())
+        jobs.append((loc, scraper_for(loc)))
 
     # Ball and Chain
     for loc in ball_and_chain.locations:
-        scrape_location(loc, ball_and_chain.Scraper())
+        jobs.append((loc, scraper_for(loc)))
+
+    scrape_locations(jobs, args.workers, args.per_host, args.timeout)
@@ -0,0 +1,170 @@
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+from web import app
+
+root_log = logging.getLogger()
+root_log.setLevel(logging.INFO)
+
+
+class SnapshotStore(object):
+    """
+    Content addressed store of raw menu HTML.
+
+    Each page is gzip compressed into its own file named by the SHA-1 digest of the HTML, so identical pages are only
+    stored once and a page can be read back as a stream without touching any other snapshot.
+    """
+
+    def __init__(self, root):
+        """
+        :param root: Directory holding the snapshots
+        :type root: str
+        """
+        self.root = root
+
+    @staticmethod
+    def digest(html):
+        """
+        Digest used to address HTML in the store. Matches Location.menu_digest.
+
+        :param html:
+        :type html: str
+        :return:
+        :rtype: str
+        """
+        return hashlib.sha1(html).hexdigest()
+
+    def path(self, digest):
+        """
+        File path of a snapshot. Snapshots are spread over subdirectories named by the first two digest characters.
+
+        :param digest:
+        :type digest: str
+        :return:
+        :rtype: str
+        """
+        return os.path.join(self.root, digest[:2], '{}.html.gz'.format(digest))
+
+    def put(self, html):
+        """
+        Store HTML unless an identical page is already stored.
+
+        :param html: Menu HTML
+        :type html: str
+        :return: Digest of the HTML
+        :rtype: str
+        """
+        digest = self.digest(html)
+        path = self.path(digest)
+        if not os.path.exists(path):
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Write to a temporary file first so a partially written snapshot is never visible
+            handle, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(handle, 'wb') as raw:
+                    with gzip.GzipFile(filename='', mode='wb', fileobj=raw) as f:
+                        f.write(html)
+                os.rename(tmp_path, path)
+            except:
+                os.remove(tmp_path)
+                raise
+        return digest
+
+    def open(self, digest):
+        """
+        Open a snapshot for streaming reads.
+
+        :param digest:
+        :type digest: str
+        :return: Decompressing file object, close when done
+        :rtype: gzip.GzipFile
+        """
+        return gzip.open(self.path(digest), 'rb')
+
+    def read(self, digest):
+        """
+        Read an entire snapshot.
+
+        :param digest:
+        :type digest: str
+        :return: Menu HTML
+        :rtype: str
+        """
+        with self.open(digest) as f:
+            return f.read()
+
+    def __contains__(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def __iter__(self):
+        """
+        Iterate over the digests of every stored snapshot.
+        """
+        if not os.path.isdir(self.root):
+            return
+        for directory in sorted(os.listdir(self.root)):
+            directory_path = os.path.join(self.root, directory)
+            if not os.path.isdir(directory_path):
+                continue
+            for filename in sorted(os.listdir(directory_path)):
+                if filename.endswith('.html.gz'):
+                    yield filename[:-len('.html.gz')]
+
+
+# Store used by the scrapers
+snapshots = SnapshotStore(app.config['SNAPSHOT_DIR'])
+
+
+def replay(menu_scrapes, store=snapshots):
+    """
+    Re-scrape stored HTML of historical menus.
+
+    :param menu_scrapes: Menus to replay, menus without a stored snapshot are skipped
+    :type menu_scrapes: MenuScrape[]
+    :param store:
+    :type store: SnapshotStore
+    :return: Generator of each MenuScrape with its freshly scraped beverages
+    :rtype: (MenuScrape, ScrapedBeverage[])[]
+    """
+    from scraper.scrape import scraper_for
+    for menu_scrape in menu_scrapes:
+        if not menu_scrape.html_digest or menu_scrape.html_digest not in store:
+            root_log.warn('No snapshot stored for {}'.format(menu_scrape))
+            continue
+        scraper = scraper_for(menu_scrape.location)
+        yield menu_scrape, scraper.scrape(store.read(menu_scrape.html_digest))
+
+
+if __name__ == '__main__':
+    from web.models import MenuScrape
+
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Re-scrape the stored HTML of a historical menu.')
+    parser.add_argument('menu_scrape_id', type=int, help='MenuScrape ID')
+    parser.add_argument('--pretty', action='store_true', help='pretty print JSON output')
+    args = parser.parse_args()
+
+    menu_scrape = MenuScrape.query.get(args.menu_scrape_id)
+    if not menu_scrape:
+        parser.error('no MenuScrape {}'.format(args.menu_scrape_id))
+    for menu, beverages in replay([menu_scrape]):
+        beverages_flat = [x.flatten() for x in beverages]
+
+        # Output beverage data as JSON
+        if args.pretty:
+            print json.dumps(beverages_flat, indent=2)
+        else:
+            print json.dumps(beverages_flat)
@@ -5,10 +5,15 @@ import re
 import urllib2
 import sys
 from abc import abstractmethod
+from collections import OrderedDict
+from datetime import datetime
+from io import BytesIO
 # TODO: Migrate to beautiful soup
+from lxml import etree
 from lxml.html import fromstring
 from unidecode import unidecode
-from web.models import Location, Chain
+from web.models import Location, Chain, ParsedValue
+from web import db
 from scraper.util import url_from_arg
 from base import ScrapedBeverage
 import base
@@ -19,10 +24,39 @@ root_log.setLevel(logging.WARN)
 chain = Chain.query.filter_by(name='Stout').first()
 locations = Location.query.filter_by(chain=chain)
 
+# Text content of an element, same as lxml.html's text_content()
+_text_content = etree.XPath('string()')
+# Start of the menu div and a charset declared in a meta tag, for skipping to the menu
+MENU_TAG_PATTERN = re.compile('<div\s[^>]*id="second-menu"')
+CHARSET_PATTERN = re.compile('<meta[^>]+charset=["\']?([\w-]+)')
+
+# Number of parsed beverage strings kept in memory
+PARSE_CACHE_SIZE = 10000
+
+# Patterns used by the extractors
+VOLUME_PATTERN = re.compile('(([0-9\.]+)(oz|ml))')
+ABV_PATTERN = re.compile('(([0-9\.]+)%)')
+PRICE_PATTERN = re.compile('(\$([0-9\.]+))')
+NAME_BREWERY_PATTERN = re.compile('(^([^-]+)-([^/]+)/)')
+NAME_PATTERN = re.compile('(^([^/]+)/)')
+LOCATION_STYLE_PATTERN = re.compile('(^([^/]+)/([^/]+))')
+CLEAN_PATTERN = re.compile('/[\s/]+/')
+# Patterns used by the tokenizer, a whole token that is a volume, ABV or price
+NUMERIC_TOKEN = re.compile('([0-9\.]+)(oz|ml)$|([0-9\.]+)%$|\$([0-9\.]+)$')
+# Anything the volume, ABV or price extractors would find inside a token
+NUMERIC_PATTERN = re.compile('[0-9\.]+(?:oz|ml|%)|\$[0-9\.]')
+
 # TODO: Move old code into Scraper
 class Scraper(base.Scraper):
+    def __init__(self, streaming=True):
+        """
+        :param streaming: Use the streaming menu parser instead of building the full document tree
+        :type streaming: bool
+        """
+        self.streaming = streaming
+
     def scrape(self, html):
-        return parse_menu(html)
+        return parse_menu(html, self.streaming)
 
 
 class ParsingException(Exception):
@@ -33,7 +67,9 @@ class ExtractionException(ParsingException):
     pass
 
 
-def parse_menu(html):
+def parse_menu(html, streaming=True):
+    if streaming:
+        return parse_sections_streaming(html)
     return parse_sections(html)
 
 
@@ -83,6 +119,204 @@ def parse_sections(html):
     return beverages
 
 
+def parse_sections_streaming(html):
+    """
+    Parse menu sections in a single streaming pass over the document. Produces the same beverages as parse_sections
+    without holding the whole document tree in memory, see iter_titles.
+
+    :param html: Stout menu web page HTML or a file object to read it from
+    :type html: str|file
+    :return:
+    :rtype: ScrapedBeverage[]
+    """
+    beverages = []
+    for section_count, beverage_count, title in iter_titles(html):
+        if title is None:
+            _log('Unable to find "p.title" in section {0} item {1}.'.format(section_count, beverage_count),
+                 logging.DEBUG)
+        elif not title:
+            _log('Empty beverage in section {0} item {1}'.format(section_count, beverage_count), logging.DEBUG)
+        else:
+            try:
+                beverage = beer_parser.parse(title)
+                _log('Parsed beverage {0} "{1}".'.format(beverage_count, beverage.name))
+                beverages.append(beverage)
+            except ParsingException as e:
+                _log(str(e), logging.DEBUG)
+    return beverages
+
+
+def iter_titles(html):
+    """
+    Find beverage titles in the menu with a single streaming pass over the document.
+
+    Headers and sections inside div#second-menu are numbered in document order and paired up just like
+    parse_sections. Titles are yielded as soon as their section's header is known, and finished elements are removed
+    from the tree as parsing goes. Parsing stops at the end of the menu.
+
+    :param html: Stout menu web page HTML or a file object to read it from
+    :type html: str|file
+    :return: Generator of section number, beverage number and title. Title is None if the beverage has no p.title.
+    :rtype: (int, int, str)[]
+    """
+    if isinstance(html, basestring):
+        source, encoding = _menu_source(html)
+    else:
+        source, encoding = html, None
+    menu = None
+    # Numbers of headers, sections and count of articles currently open
+    open_headers = []
+    open_sections = []
+    open_articles = 0
+    header_count = 0
+    section_count = 0
+    # Section names by header number, None if the header has no h2
+    names = {}
+    # Titles found by section number and section numbers that have been closed
+    titles = {}
+    closed = set()
+    pairing = _TitlePairing(names, titles, closed)
+    for event, element in etree.iterparse(source, events=('start', 'end'), html=True, encoding=encoding,
+                                          tag=('div', 'header', 'section', 'article')):
+        if menu is None:
+            if event == 'start' and element.tag == 'div' and element.get('id') == 'second-menu':
+                menu = element
+            elif event == 'end':
+                _release(element)
+            continue
+        if event == 'start':
+            if element.tag == 'header':
+                header_count += 1
+                open_headers.append(header_count)
+            elif element.tag == 'section':
+                section_count += 1
+                open_sections.append(section_count)
+                titles[section_count] = []
+            elif element.tag == 'article':
+                open_articles += 1
+            continue
+        if element is menu:
+            break
+        if element.tag == 'header':
+            h2 = next(element.iter('h2'), None)
+            names[open_headers.pop()] = _text_content(h2).strip() if h2 is not None else None
+        elif element.tag == 'section':
+            closed.add(open_sections.pop())
+        elif element.tag == 'article':
+            open_articles -= 1
+            title = next((x for x in element.iter('p') if x.get('class') == 'title'), None)
+            title = _text_content(title).strip() if title is not None else None
+            for index in open_sections:
+                titles[index].append(title)
+        else:
+            continue
+        if not open_headers and not open_articles:
+            _release(element)
+        for item in pairing.ready():
+            yield item
+
+    if menu is None:
+        _log('Unable to find "div#second-menu" when parsing menu.', logging.ERROR)
+        raise ParsingException('Unable to find "div#second-menu" when parsing menu.')
+    # Anything left open by broken markup is as finished as it will get
+    closed.update(open_sections)
+    for item in pairing.ready():
+        yield item
+
+    _log('Found {0} headers and {1} sections in menu.'.format(header_count, section_count), logging.INFO)
+    if header_count != section_count:
+        _log('Number of headers {0} does not match number of sections {1}'.format(header_count, section_count),
+             logging.WARN)
+
+
+def _menu_source(html):
+    """
+    Source for iter_titles starting at the menu div, everything before it is skipped without being parsed.
+
+    The page's declared charset is passed along since the meta tags are skipped too. The whole page is used if the
+    menu div can not be found by a plain search or the match may be inside a comment or script.
+
+    :param html: Stout menu web page HTML
+    :type html: str|unicode
+    :return: File object and its encoding
+    :rtype: (BytesIO, str)
+    """
+    if isinstance(html, unicode):
+        html = html.encode('utf-8')
+        charset = 'utf-8'
+    else:
+        charset = None
+    start = html.find('id="second-menu"')
+    if start != -1:
+        start = html.rfind('<', 0, start)
+        head = html[:start].lower()
+        if MENU_TAG_PATTERN.match(html, start) \
+                and head.rfind('<!--') <= head.rfind('-->') \
+                and head.rfind('<script') <= head.rfind('</script'):
+            if not charset:
+                charset = CHARSET_PATTERN.search(head)
+                charset = charset.group(1) if charset else None
+            if charset:
+                return BytesIO(html[start:]), charset
+    return BytesIO(html), charset
+
+
+class _TitlePairing(object):
+    """
+    Pairs the nth header with the nth section for iter_titles, releasing titles once the header is known.
+    """
+
+    def __init__(self, names, titles, closed):
+        self.names = names
+        self.titles = titles
+        self.closed = closed
+        self.section = 1
+        self.beverage_count = 0
+
+    def ready(self):
+        """
+        Titles that can be released, in order.
+
+        :return:
+        :rtype: (int, int, str)[]
+        """
+        ready = []
+        while self.section in self.names and self.section in self.titles:
+            name = self.names[self.section]
+            section_titles = self.titles[self.section]
+            if name is None:
+                if self.section in self.closed:
+                    _log('Unable to find "h2" in header {0}'.format(self.section), logging.WARN)
+            elif 'Wine' not in name:
+                if not self.beverage_count and section_titles:
+                    _log('Parsing section {0} "{1}".'.format(self.section, name))
+                for title in section_titles:
+                    self.beverage_count += 1
+                    ready.append((self.section, self.beverage_count, title))
+            del section_titles[:]
+            if self.section not in self.closed:
+                break
+            del self.names[self.section]
+            del self.titles[self.section]
+            self.section += 1
+            self.beverage_count = 0
+        return ready
+
+
+def _release(element):
+    """
+    Free a finished element and everything before it in the tree.
+
+    :param element:
+    :type element: etree.Element
+    :return:
+    :rtype:
+    """
+    element.clear()
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+
+
 def _parse_section(header_element, section_element, section_count):
     """
     Parse a menu header and section element into a section dict.
@@ -148,8 +382,7 @@ def _parse_beverage(beverage_element, is_wine, beverage_count, section_count):
         name = name[0].text_content().strip()
         if name:
             try:
-                parser = BeerParser()
-                return parser.parse(name)
+                return beer_parser.parse(name)
             except ParsingException as e:
                 _log(str(e), logging.DEBUG)
         else:
@@ -160,14 +393,20 @@ def _parse_beverage(beverage_element, is_wine, beverage_count, section_count):
 
 
 class BeerParser(object):
+    # Bump whenever a parsing change alters output, invalidates cached parses
+    version = 1
+
     def __init__(self):
-        self.extractors = [
-            VolumeExtractor(),
-            AbvExtractor(),
-            PriceExtractor(),
-            NameBreweryExtractor(),
-            LocationStyleExtractor()
-        ]
+        self.extractors = [x() for x in default_extractors]
+
+    def fingerprint(self):
+        """
+        Identify the parsing rules in use. Changes with the parser version or the extractor list.
+
+        :return:
+        :rtype: str
+        """
+        return '{}:{}'.format(self.version, ','.join(type(x).__name__ for x in self.extractors))
 
     def parse(self, value):
         """
@@ -181,21 +420,112 @@ class BeerParser(object):
         """
         beverage = ScrapedBeverage(type='Beer', scraped_value=value)
         value = self.prep(value)
+        data = None
+        # The tokenizer only knows how to do the work of the default extractors
+        if [type(x) for x in self.extractors] == default_extractors:
+            data = self.tokenize(value)
+        if data is None:
+            data = self.extract(value)
+        for k, v in data.iteritems():
+            beverage.__setattr__(k, v)
+        if beverage.name:
+            beverage.availability = 'Bottle' if beverage.volume else 'On Tap'
+            return beverage
+        else:
+            raise ParsingException()
+
+    def extract(self, value):
+        """
+        Run each extractor in turn over a prepared beverage string.
+
+        :param value:
+        :type value: str
+        :return: Extracted beverage data
+        :rtype: dict
+        """
+        extracted = {}
         for extractor in self.extractors:
             try:
                 data = extractor.extract(self.clean(value))
                 value = data.get('__value')
                 del data['__value']
-                for k, v in data.iteritems():
-                    beverage.__setattr__(k, v)
+                extracted.update(data)
             except ExtractionException as e:
                 _log(str(e), logging.DEBUG)
                 pass
-        if beverage.name:
-            beverage.availability = 'Bottle' if beverage.volume else 'On Tap'
-            return beverage
+        return extracted
+
+    def tokenize(self, value):
+        """
+        Extract beverage data from a prepared beverage string in a single pass over its slash delimited tokens.
+
+        Tokens that are entirely a volume, ABV or price are assigned directly, the first remaining token holds
+        "<name> - <brewery>" and the next two hold location and style. Gives exactly the same data as the default
+        extractors. Returns None when the string has a shape where the extractors would reach past token boundaries,
+        like a volume inside a name, a second price or a slash without whitespace around it (clean() leaves "//"
+        alone), so the caller can fall back to them.
+
+        :param value:
+        :type value: str
+        :return: Extracted beverage data or None
+        :rtype: dict
+        """
+        data = {}
+        texts = []
+        tokens = value.split('/')
+        last = len(tokens) - 1
+        for i, token in enumerate(tokens):
+            if (i > 0 and not token[:1].isspace()) or (i < last and not token[-1:].isspace()):
+                return None
+            stripped = token.strip()
+            if not stripped:
+                if i == 0:
+                    return None
+                continue
+            numeric = NUMERIC_TOKEN.match(stripped)
+            if numeric:
+                volume, volume_units, abv, price = numeric.groups()
+                key = 'volume' if volume else 'abv' if abv else 'price'
+                if i == 0 or key in data:
+                    return None
+                try:
+                    data[key] = float(volume or abv or price)
+                except ValueError:
+                    return None
+                if volume_units:
+                    data['volume_units'] = volume_units
+            elif NUMERIC_PATTERN.search(token):
+                return None
+            else:
+                texts.append(token)
+                last_text = i
+        # Whether anything other than whitespace followed the last text token, leaving a trailing slash
+        trailing_slash = last_text < last
+
+        # Name and brewery from the first token
+        first = texts[0]
+        if len(texts) == 1 and not trailing_slash:
+            return None
+        if any(x.endswith(first) for x in texts[1:]):
+            return None
+        dash = first.find('-')
+        if dash == -1:
+            if any('-' in x for x in texts[1:]):
+                return None
+            data['name'] = first.strip()
+        elif dash == 0 or dash == len(first) - 1:
+            return None
         else:
-            raise ParsingException()
+            data['name'] = first[:dash].strip()
+            data['brewery'] = first[dash + 1:].strip()
+
+        # Location and style from the next two
+        if len(texts) >= 3:
+            data['brewery_location'] = texts[1].strip()
+            data['style'] = texts[2].strip()
+        elif len(texts) == 2 and trailing_slash:
+            return None
+        return data
 
     def clean(self, value):
         """
@@ -206,7 +536,7 @@ class BeerParser(object):
         :return:
         :rtype: str
         """
-        return re.sub('/[\s/]+/', '/', value)
+        return CLEAN_PATTERN.sub('/', value)
 
     def prep(self, value):
         """
@@ -226,6 +556,118 @@ class BeerParser(object):
             .replace('Weihenstephaner Original - Germ', 'Weihenstephaner Original - Weihenstephan / Germ')
 
 
+class CachedBeerParser(object):
+    """
+    Memoizes BeerParser results in a bounded LRU keyed on the scraped value. Optionally persists results in the
+    database so unchanged menu lines are never parsed again across runs. New results are held until saved, on their own
+    transaction so rolling back a menu doesn't lose them.
+
+    Entries are tied to the parser fingerprint and dropped when it changes. Every hit returns a new ScrapedBeverage
+    so callers cannot modify cached entries.
+    """
+
+    def __init__(self, parser=None, size=PARSE_CACHE_SIZE):
+        """
+        :param parser:
+        :type parser: BeerParser
+        :param size: Maximum number of scraped values kept in memory
+        :type size: int
+        """
+        self.parser = parser or BeerParser()
+        self.size = size
+        self.persist = False
+        self.entries = OrderedDict()
+        # Results parsed since the last save, by scraped value
+        self.unsaved = OrderedDict()
+        self.fingerprint = self.parser.fingerprint()
+
+    def parse(self, value):
+        """
+        Parse a beverage string into a ScrapedBeverage, see BeerParser.parse.
+
+        :param value:
+        :type value: str|unicode
+        :return:
+        :rtype: ScrapedBeverage
+        """
+        self._check_fingerprint()
+        if value in self.entries:
+            data = self.entries.pop(value)
+            self.entries[value] = data
+        else:
+            try:
+                beverage = self.parser.parse(value)
+                data = dict((k, v) for k, v in beverage.__dict__.iteritems() if k not in ['scraped_value', 'created'])
+            except ParsingException:
+                data = None
+            self._store(value, data)
+            if self.persist:
+                self.unsaved[value] = data
+        if data is None:
+            raise ParsingException()
+        return ScrapedBeverage(scraped_value=value, **data)
+
+    def load(self):
+        """
+        Load persisted results for the current parser and persist new results from now on, see save. Results from any
+        other parser version are deleted.
+
+        :return:
+        :rtype:
+        """
+        self._check_fingerprint()
+        with db.engine.begin() as connection:
+            connection.execute(ParsedValue.__table__.delete().where(ParsedValue.parser != self.fingerprint))
+        rows = db.session.query(ParsedValue.scraped_value, ParsedValue.data) \
+            .filter(ParsedValue.parser == self.fingerprint).order_by(ParsedValue.id.desc()).limit(self.size).all()
+        for row in reversed(rows):
+            self._store(row.scraped_value, json.loads(row.data))
+        self.persist = True
+
+    def save(self):
+        """
+        Write the results parsed since the last save, replacing any already stored for the same parser and value.
+
+        Written on a transaction of their own, call it while the database session has no writes pending. Results are
+        kept to be saved again if the write fails.
+
+        :return: Number of results written
+        :rtype: int
+        """
+        if not self.unsaved:
+            return 0
+        created = datetime.now()
+        with db.engine.begin() as connection:
+            connection.execute(ParsedValue.__table__.insert().prefix_with('OR REPLACE'), [{
+                'parser': self.fingerprint,
+                'scraped_value': value,
+                'data': json.dumps(data),
+                'created': created,
+            } for value, data in self.unsaved.iteritems()])
+        saved = len(self.unsaved)
+        self.unsaved.clear()
+        return saved
+
+    def clear(self):
+        self.entries.clear()
+        self.unsaved.clear()
+
+    def _store(self, value, data):
+        self.entries[value] = data
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def _check_fingerprint(self):
+        """
+        Drop cached results if the parser version or extractors changed.
+        """
+        fingerprint = self.parser.fingerprint()
+        if fingerprint != self.fingerprint:
+            _log('Parser changed from {} to {}, clearing parse cache'.format(self.fingerprint, fingerprint))
+            self.fingerprint = fingerprint
+            self.clear()
+
+
 class Extractor(object):
     @abstractmethod
     def extract(self, value):
@@ -247,7 +689,7 @@ class VolumeExtractor(Extractor):
         """
         Extract volume by searching for "<number><units>".
         """
-        search = re.search('(([0-9\.]+)(oz|ml))', value)
+        search = VOLUME_PATTERN.search(value)
         if search and len(search.groups()) == 3:
             try:
                 return {
@@ -266,7 +708,7 @@ class AbvExtractor(Extractor):
         """
         Extract ABV by searching for "<number>%".
         """
-        search = re.search('(([0-9\.]+)%)', value)
+        search = ABV_PATTERN.search(value)
         if search and len(search.groups()) == 2:
             try:
                 return {
@@ -284,7 +726,7 @@ class PriceExtractor(Extractor):
         """
         Extract price by searching for "$<number>".
         """
-        search = re.search('(\$([0-9\.]+))', value)
+        search = PRICE_PATTERN.search(value)
         if search and len(search.groups()) == 2:
             try:
                 return {
@@ -302,7 +744,7 @@ class NameBreweryExtractor(Extractor):
         """
         Extract name and brewery by searching the start of the string for "<name> - <brewery>".
         """
-        search = re.search('(^([^-]+)-([^/]+)/)', value)
+        search = NAME_BREWERY_PATTERN.search(value)
         if search and len(search.groups()) == 3:
             return {
                 '__value': value.replace(search.group(1), ''),
@@ -310,7 +752,7 @@ class NameBreweryExtractor(Extractor):
                 'brewery': search.group(3).strip()
             }
         else:
-            search = re.search('(^([^/]+)/)', value)
+            search = NAME_PATTERN.search(value)
             if search and len(search.groups()) == 2:
                 return {
                     '__value': value.replace(search.group(1), ''),
@@ -325,7 +767,7 @@ class LocationStyleExtractor(Extractor):
         Extract location and style by searching the start of the string for "<location> / <style>". Requires that other
         data has been removed as location and style are not easily parsable.
         """
-        search = re.search('(^([^/]+)/([^/]+))', value)
+        search = LOCATION_STYLE_PATTERN.search(value)
         if search and len(search.groups()) == 3:
             return {
                 '__value': value.replace(search.group(1), ''),
@@ -335,6 +777,19 @@ class LocationStyleExtractor(Extractor):
         raise ExtractionException('Unable to extract location or style. value={}'.format(value))
 
 
+# Extractors run by BeerParser, in order
+default_extractors = [
+    VolumeExtractor,
+    AbvExtractor,
+    PriceExtractor,
+    NameBreweryExtractor,
+    LocationStyleExtractor
+]
+
+# Parser used for menu scrapes
+beer_parser = CachedBeerParser()
+
+
 def _log(message, level=logging.INFO):
     root_log.log(level, message)
 
@@ -30,6 +30,20 @@ class TestScraper(unittest.TestCase):
             del actual_flat['created']
             self.assertEqual(expected[i], actual_flat)
 
+    def test_restricted_matches_full(self):
+        """ Test parsing only the menu containers gives the same beverages as parsing the full page """
+        html_fixture = os.path.join('fixtures', 'ball_and_chain_menu', 'hollywood_2014-10-1.html')
+        with file(html_fixture) as f:
+            html = f.read()
+        def flatten(beverages):
+            # Ignore timestamps
+            return [dict(x.flatten(), created=None) for x in beverages]
+
+        expected = flatten(Scraper(restricted=False).scrape(html))
+        # Missing END comment falls back to parsing the full page
+        for page in (html, html.decode('utf-8'), html.replace('<!-- END on_tap_content -->', '')):
+            self.assertEqual(expected, flatten(Scraper().scrape(page)))
+
 
 if __name__ == '__main__':
     unittest.main()
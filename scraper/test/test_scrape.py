@@ -0,0 +1,39 @@
+from datetime import datetime
+from scraper.scrape import FetchedMenu, ingest_menu
+from web import db
+from web.models import Location
+from web.testing import DatabaseTestCase
+import logging
+
+root_log = logging.getLogger()
+root_log.setLevel(logging.WARN)
+root_log.addHandler(logging.NullHandler())
+
+
+class TestIngestMenu(DatabaseTestCase):
+    def setUp(self):
+        super(TestIngestMenu, self).setUp()
+        self.menu = FetchedMenu('<html>menu</html>', '"old"', 'Mon, 25 Aug 2014 00:00:00 GMT')
+        self.location = Location(name='Test', url='http://example.com/menu')
+        self.location.menu_etag = self.menu.etag
+        self.location.menu_last_modified = self.menu.last_modified
+        self.location.menu_digest = self.menu.digest
+        db.session.add(self.location)
+        db.session.commit()
+        self.location_id = self.location.id
+
+    def test_unchanged_validators(self):
+        """ Test that an unchanged menu stores the validators it was downloaded with """
+        checked = datetime(2014, 8, 26)
+        ingest_menu(self.location, None, FetchedMenu(self.menu.html, '"new"', 'Tue, 26 Aug 2014 00:00:00 GMT'), checked)
+        location = Location.query.get(self.location_id)
+        self.assertEqual('"new"', location.menu_etag)
+        self.assertEqual('Tue, 26 Aug 2014 00:00:00 GMT', location.menu_last_modified)
+        self.assertEqual(checked, location.menu_checked)
+
+    def test_unchanged_without_validators(self):
+        """ Test that a menu downloaded without validators keeps the previous ones """
+        ingest_menu(self.location, None, FetchedMenu(self.menu.html))
+        location = Location.query.get(self.location_id)
+        self.assertEqual('"old"', location.menu_etag)
+        self.assertEqual('Mon, 25 Aug 2014 00:00:00 GMT', location.menu_last_modified)
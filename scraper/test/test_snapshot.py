@@ -0,0 +1,37 @@
+import unittest
+import os
+import shutil
+import tempfile
+from scraper.snapshot import SnapshotStore
+
+
+class TestSnapshotStore(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = SnapshotStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_round_trip(self):
+        """ Test stored HTML reads back unchanged """
+        html_fixture = os.path.join('fixtures', 'stout_menu', 'hollywood_2014-08-25.html')
+        with file(html_fixture) as f:
+            html = f.read()
+        digest = self.store.put(html)
+        self.assertIn(digest, self.store)
+        self.assertEqual(html, self.store.read(digest))
+        self.assertLess(os.path.getsize(self.store.path(digest)), len(html))
+
+    def test_identical_pages_stored_once(self):
+        """ Test that identical HTML shares a single snapshot """
+        first = self.store.put('<html>menu</html>')
+        second = self.store.put('<html>menu</html>')
+        third = self.store.put('<html>new menu</html>')
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, third)
+        self.assertEqual(sorted([first, third]), sorted(self.store))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,10 @@
 import unittest
 import os
 import json
-from scraper.stout import BeerParser, Scraper
-from web.models import Beverage
+from scraper.stout import BeerParser, CachedBeerParser, ParsingException, Scraper, parse_menu
+from web import db
+from web.models import Beverage, ParsedValue
+from web.testing import DatabaseTestCase
 import logging
 
 root_log = logging.getLogger()
@@ -31,6 +33,22 @@ class TestMenuParsing(unittest.TestCase):
             del actual_flat['created']
             self.assertEqual(expected[i], actual_flat)
 
+    def test_streaming_matches_tree(self):
+        """ Test that the streaming parser finds the same beverages as the full tree parser """
+        html_fixture = os.path.join('fixtures', 'stout_menu', 'hollywood_2014-08-25.html')
+        with file(html_fixture) as f:
+            html = f.read()
+        for source in [html, html.decode('utf-8')]:
+            expected = [x.flatten() for x in parse_menu(source, streaming=False)]
+            actual = [x.flatten() for x in parse_menu(source, streaming=True)]
+            for beverage in expected + actual:
+                del beverage['created']
+            self.assertEqual(expected, actual)
+
+    def test_streaming_requires_menu(self):
+        """ Test that a page without the menu is an error """
+        self.assertRaises(ParsingException, parse_menu, '<html><body><div id="menu"></div></body></html>')
+
 
 class TestBeerParser(unittest.TestCase):
     def test_basic_parse(self):
@@ -84,6 +102,107 @@ class TestBeerParser(unittest.TestCase):
         self.assertEqual('Saison Dupont Cuvee Dry Hop', actual.name)
         self.assertEqual('Dupont', actual.brewery)
 
+    def test_tokenize_matches_extractors(self):
+        """ Test that the tokenizer extracts the same data as the extractors or defers to them. """
+        parser = BeerParser()
+        strings = [
+            'Saison Dupont Cuvee Dry Hop - Dupont / Belg / Saison / 22oz / 6.5% / $10',
+            'Old Speckled Hen - Green King / UK / Cream Ale / Nitro / 5.2%',
+            'Bitburger Drive -Bitburger Brauerei / Germany / Non-Alcoholic Lager / 0.5% / 12oz',
+            'Avec Les Bons Voeux 2012 - Dupont / Belg / Xmas Saison / 9.5%',
+            'Pliny - Russian River / CA / 8%',
+            'Pliny / Russian River / CA-Sonoma / 8%',
+            'Pliny - Russian River / CA / 8% / $7 / $8',
+            'Tequila Barrel - Foo / 100% Agave / IPA / 7%',
+            'Nitro - Foo / CA / IPA / 5%/ $7',
+            'Name / Other Name / Name / 5%',
+            'Name - Brewery',
+        ]
+        tokenized = 0
+        for string in strings:
+            value = parser.prep(string)
+            data = parser.tokenize(value)
+            if data is not None:
+                tokenized += 1
+                self.assertEqual(parser.extract(value), data, string)
+        self.assertEqual(4, tokenized)
+
+
+class TestCachedBeerParser(unittest.TestCase):
+    def test_cached_copies(self):
+        """ Test that cached results match the parser and can't be modified by callers. """
+        parser = CachedBeerParser(BeerParser())
+        string = 'Saison Dupont Cuvee Dry Hop - Dupont / Belg / Saison / 22oz / 6.5% / $10'
+        first = parser.parse(string)
+        first.name = 'Modified'
+        second = parser.parse(string)
+        self.assertEqual('Saison Dupont Cuvee Dry Hop', second.name)
+        self.assertEqual(string, second.scraped_value)
+        expected = BeerParser().parse(string)
+        expected.created = second.created
+        self.assertEqual(expected.flatten(), second.flatten())
+
+    def test_failures_cached(self):
+        """ Test that unparsable strings keep raising. """
+        parser = CachedBeerParser(BeerParser())
+        self.assertRaises(ParsingException, parser.parse, 'Name - Brewery')
+        self.assertRaises(ParsingException, parser.parse, 'Name - Brewery')
+
+    def test_bounded(self):
+        """ Test that the least recently used entries are evicted. """
+        parser = CachedBeerParser(BeerParser(), size=2)
+        parser.parse('A - B / C / D / 5%')
+        parser.parse('E - F / G / H / 5%')
+        parser.parse('A - B / C / D / 5%')
+        parser.parse('I - J / K / L / 5%')
+        self.assertEqual(['A - B / C / D / 5%', 'I - J / K / L / 5%'], parser.entries.keys())
+
+    def test_invalidated_by_version(self):
+        """ Test that changing the parser version clears the cache. """
+        parser = CachedBeerParser(BeerParser())
+        parser.parse('A - B / C / D / 5%')
+        parser.parser.version += 1
+        parser.parse('E - F / G / H / 5%')
+        self.assertEqual(['E - F / G / H / 5%'], parser.entries.keys())
+
+
+class TestPersistedBeerParser(DatabaseTestCase):
+    def stored(self):
+        return sorted(x for x, in db.session.query(ParsedValue.scraped_value))
+
+    def test_saved_after_rollback(self):
+        """ Test that results parsed while a menu is rolled back are still saved. """
+        parser = CachedBeerParser(BeerParser())
+        parser.load()
+        parser.parse('A - B / C / D / 5%')
+        db.session.rollback()
+        self.assertEqual(1, parser.save())
+        self.assertEqual(['A - B / C / D / 5%'], self.stored())
+        self.assertEqual(0, parser.save())
+
+    def test_parsed_again(self):
+        """ Test that a value evicted and parsed again replaces its stored result. """
+        parser = CachedBeerParser(BeerParser(), size=1)
+        parser.load()
+        parser.parse('A - B / C / D / 5%')
+        parser.save()
+        parser.parse('E - F / G / H / 5%')
+        parser.parse('A - B / C / D / 5%')
+        self.assertEqual(2, parser.save())
+        self.assertEqual(['A - B / C / D / 5%', 'E - F / G / H / 5%'], self.stored())
+
+    def test_loaded(self):
+        """ Test that saved results are loaded by the next run. """
+        parser = CachedBeerParser(BeerParser())
+        parser.load()
+        parser.parse('A - B / C / D / 5%')
+        parser.save()
+        parser = CachedBeerParser(BeerParser())
+        parser.load()
+        self.assertEqual(['A - B / C / D / 5%'], parser.entries.keys())
+        self.assertEqual('A', parser.parse('A - B / C / D / 5%').name)
+        self.assertEqual(0, parser.save())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,32 @@
+"""
+Add columns to Location for skipping unchanged menus. Stores the ETag, Last-Modified and SHA-1 digest of the last menu
+downloaded along with the last time the menu was checked.
+"""
+
+import logging
+import sys
+from scripts.util import add_columns
+
+root_log = logging.getLogger()
+root_log.setLevel(logging.INFO)
+
+columns = [
+    ('menu_etag', 'VARCHAR(128)'),
+    ('menu_last_modified', 'VARCHAR(64)'),
+    ('menu_digest', 'VARCHAR(40)'),
+    ('menu_checked', 'DATETIME'),
+]
+
+
+def upgrade():
+    add_columns('location', columns)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+
+    upgrade()
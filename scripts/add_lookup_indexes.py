@@ -0,0 +1,120 @@
+"""
+Index the columns beverages, breweries, menus and distinct beers are looked up by. Brewery names, beverage names per
+brewery and distinct beers per user become unique, so existing duplicates are merged first.
+
+Query plans of the lookups are logged before and after.
+"""
+
+import logging
+import sys
+from web import db
+from web.models import Brewery, Beverage, MenuScrape, BeverageScrape, DistinctBeer
+from scripts.util import create_indexes, query_plan
+
+root_log = logging.getLogger()
+root_log.setLevel(logging.INFO)
+
+tables = [Brewery.__tablename__, Beverage.__tablename__, MenuScrape.__tablename__, BeverageScrape.__tablename__,
+          DistinctBeer.__tablename__]
+
+# Lookups the indexes are for
+queries = [
+    ('SELECT id FROM beverage WHERE name = ? AND brewery_id = ?', ('', 0)),
+    ('SELECT id FROM beverage WHERE untappd_id = ?', ('',)),
+    ('SELECT id FROM brewery WHERE name = ?', ('',)),
+    ('SELECT id FROM distinct_beer WHERE user_id = ? AND untappd_bid = ?', (0, 0)),
+    ('SELECT id FROM distinct_beer WHERE untappd_bid = ?', (0,)),
+    ('SELECT id FROM menu_scrape WHERE location_id = ? ORDER BY created DESC LIMIT 1', (0,)),
+    ('SELECT id FROM beverage_scrape WHERE menu_scrape_id = ?', (0,)),
+]
+
+
+def merge_breweries():
+    """
+    Merge breweries sharing a name into the oldest one, moving their beverages over.
+    """
+    duplicates = db.engine.execute(
+        'SELECT name, MIN(id) AS id FROM brewery GROUP BY name HAVING COUNT(*) > 1').fetchall()
+    for name, keep_id in duplicates:
+        with db.engine.begin() as connection:
+            # Fill in anything the kept brewery is missing
+            connection.execute(
+                'UPDATE brewery SET '
+                'location = COALESCE(location, (SELECT MAX(location) FROM brewery WHERE name = ?)), '
+                'untappd_id = COALESCE(untappd_id, (SELECT MAX(untappd_id) FROM brewery WHERE name = ?)) '
+                'WHERE id = ?', (name, name, keep_id))
+            connection.execute(
+                'UPDATE beverage SET brewery_id = ? WHERE brewery_id IN '
+                '(SELECT id FROM brewery WHERE name = ? AND id != ?)', (keep_id, name, keep_id))
+            result = connection.execute('DELETE FROM brewery WHERE name = ? AND id != ?', (name, keep_id))
+        root_log.info('Merged {} duplicate breweries into {} "{}"'.format(result.rowcount, keep_id, name))
+
+
+def merge_beverages():
+    """
+    Merge beverages sharing a name and brewery into the oldest one, moving their scrapes and distinct beers over.
+    """
+    duplicates = db.engine.execute(
+        'SELECT name, brewery_id, MIN(id) AS id FROM beverage WHERE brewery_id IS NOT NULL '
+        'GROUP BY name, brewery_id HAVING COUNT(*) > 1').fetchall()
+    for name, brewery_id, keep_id in duplicates:
+        with db.engine.begin() as connection:
+            merged = [x for x, in connection.execute(
+                'SELECT id FROM beverage WHERE name = ? AND brewery_id = ? AND id != ?', (name, brewery_id, keep_id))]
+            placeholders = ', '.join('?' * len(merged))
+            # Fill in anything the kept beverage is missing
+            connection.execute(
+                'UPDATE beverage SET '
+                'untappd_id = COALESCE(untappd_id, (SELECT MAX(untappd_id) FROM beverage WHERE id IN ({0}))), '
+                'style = COALESCE(style, (SELECT MAX(style) FROM beverage WHERE id IN ({0}))), '
+                'abv = COALESCE(abv, (SELECT MAX(abv) FROM beverage WHERE id IN ({0}))) '
+                'WHERE id = ?'.format(placeholders), merged * 3 + [keep_id])
+            for table in (BeverageScrape.__tablename__, DistinctBeer.__tablename__):
+                connection.execute('UPDATE {} SET beverage_id = ? WHERE beverage_id IN ({})'.format(
+                    table, placeholders), [keep_id] + merged)
+            connection.execute('DELETE FROM beverage WHERE id IN ({})'.format(placeholders), merged)
+        root_log.info('Merged {} duplicate beverages into {} "{}"'.format(len(merged), keep_id, name))
+
+
+def merge_distinct_beers():
+    """
+    Keep the oldest of a user's distinct beers with the same Untappd ID, along with any beverage linked to the others.
+    """
+    with db.engine.begin() as connection:
+        connection.execute(
+            'UPDATE distinct_beer SET beverage_id = '
+            '(SELECT MAX(d.beverage_id) FROM distinct_beer d '
+            'WHERE d.user_id = distinct_beer.user_id AND d.untappd_bid = distinct_beer.untappd_bid) '
+            'WHERE beverage_id IS NULL AND untappd_bid IS NOT NULL')
+        result = connection.execute(
+            'DELETE FROM distinct_beer WHERE untappd_bid IS NOT NULL AND id NOT IN '
+            '(SELECT MIN(id) FROM distinct_beer GROUP BY user_id, untappd_bid)')
+    root_log.info('Removed {} duplicate distinct beers'.format(result.rowcount))
+
+
+def log_query_plans():
+    for sql, params in queries:
+        root_log.info('{}: {}'.format(sql, '; '.join(query_plan(sql, params))))
+
+
+def upgrade():
+    root_log.info('Query plans before')
+    log_query_plans()
+    merge_breweries()
+    merge_beverages()
+    merge_distinct_beers()
+    for table in tables:
+        create_indexes(table)
+    db.engine.execute('ANALYZE')
+    root_log.info('Query plans after')
+    log_query_plans()
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+
+    upgrade()
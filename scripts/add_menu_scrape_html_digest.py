@@ -0,0 +1,28 @@
+"""
+Add MenuScrape.html_digest linking a menu to its raw HTML in the snapshot store.
+"""
+
+import logging
+import sys
+from scripts.util import add_columns
+
+root_log = logging.getLogger()
+root_log.setLevel(logging.INFO)
+
+columns = [
+    ('html_digest', 'VARCHAR(40)'),
+]
+
+
+def upgrade():
+    add_columns('menu_scrape', columns)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+
+    upgrade()
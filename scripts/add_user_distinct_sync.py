@@ -0,0 +1,29 @@
+"""
+Add the User columns tracking incremental distinct beer syncs.
+"""
+
+import logging
+import sys
+from scripts.util import add_columns
+
+root_log = logging.getLogger()
+root_log.setLevel(logging.INFO)
+
+columns = [
+    ('distinct_checkin_id', 'INTEGER'),
+    ('distinct_synced_at', 'DATETIME'),
+]
+
+
+def upgrade():
+    add_columns('user', columns)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+
+    upgrade()
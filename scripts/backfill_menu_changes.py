@@ -0,0 +1,52 @@
+"""
+Build the menu change log from existing menus.
+
+Each location's menus newer than the last change already in the log are logged, so this can be re-run at any time. Use
+--rebuild to start every location's log over, needed after historical BeverageScrapes are re-linked.
+"""
+
+import argparse
+import logging
+import sys
+from sqlalchemy.sql import func
+from web import db
+from web.models import Location, MenuChange
+from web.menu_diff import log_location_changes
+
+root_log = logging.getLogger()
+root_log.setLevel(logging.INFO)
+
+
+def backfill(rebuild=False):
+    """
+    Log the changes of every location's menus, one transaction per location.
+
+    :param rebuild: Delete each location's existing log first
+    :type rebuild: bool
+    :return:
+    :rtype:
+    """
+    for location in Location.query.order_by(Location.id).all():
+        after = None
+        if rebuild:
+            MenuChange.query.filter_by(location_id=location.id).delete()
+        else:
+            after = db.session.query(func.max(MenuChange.created)).filter_by(location_id=location.id).scalar()
+        menus, changes = log_location_changes(location.id, after)
+        db.session.commit()
+        root_log.info('Logged {} changes over {} menus for {}'.format(changes, menus, location))
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Build the menu change log from existing menus.')
+    parser.add_argument('--rebuild', action='store_true', help='start every location\'s log over')
+    args = parser.parse_args()
+
+    backfill(args.rebuild)
@@ -0,0 +1,65 @@
+"""
+Run queued jobs, see web.jobs.
+
+Each worker process claims and runs one job at a time. Jobs can also be queued from here, e.g. to run a maintenance
+script in the background:
+    python -m scripts.job_worker --script backfill_menu_changes --rebuild
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+from web import db
+from web.jobs import enqueue, work, scripts, POLL_INTERVAL
+
+root_log = logging.getLogger()
+root_log.setLevel(logging.INFO)
+
+
+def start(once=False, poll=POLL_INTERVAL):
+    """
+    Work on jobs in this process.
+
+    :param once: Stop when there are no jobs left
+    :type once: bool
+    :param poll: Seconds to wait between looking for jobs when idle
+    :type poll: int
+    :return:
+    :rtype:
+    """
+    # Connections can't be shared with the parent process
+    db.engine.dispose()
+    work('{}:{}'.format(socket.gethostname(), os.getpid()), once, poll)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(processName)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Run queued jobs.')
+    parser.add_argument('--processes', type=int, default=1, help='number of jobs run at once')
+    parser.add_argument('--once', action='store_true', help='stop when there are no jobs left')
+    parser.add_argument('--poll', type=int, default=POLL_INTERVAL, help='seconds to wait for jobs when idle')
+    parser.add_argument('--script', nargs=argparse.REMAINDER, metavar='SCRIPT',
+                        help='queue a maintenance script with its arguments and exit: {}'.format(', '.join(scripts())))
+    args = parser.parse_args()
+
+    if args.script:
+        if args.script[0] not in scripts():
+            parser.error('unknown script {}'.format(args.script[0]))
+        job = enqueue('script', name=args.script[0], args=args.script[1:])
+        root_log.info('Queued {}'.format(job))
+        sys.exit(0)
+
+    workers = [multiprocessing.Process(target=start, args=(args.once, args.poll)) for i in range(args.processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
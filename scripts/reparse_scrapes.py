@@ -0,0 +1,206 @@
+"""
+Re-derive historical BeverageScrapes after a parser improvement.
+
+By default every BeverageScrape with a scraped_value is re-parsed with the current stout.BeerParser and re-linked to the
+Beverage the new result resolves to. With --html every MenuScrape with a stored snapshot is re-scraped instead and its
+BeverageScrapes rebuilt. Parsing runs in a process pool across all cores, results stream back in chunks and each chunk
+is applied in a single transaction. Every change is logged so the effect of the new parser can be reviewed, use
+--dry-run to only report. The menu change log is rebuilt afterwards since menus may now have different beverages.
+"""
+
+import argparse
+import logging
+import multiprocessing
+import sys
+from sqlalchemy import bindparam
+from web import db
+from web.models import BeverageScrape, MenuScrape, Location
+from scraper.scrape import resolve_beverages, scrapers
+from scraper.snapshot import snapshots
+from scraper.stout import BeerParser, ParsingException
+from scripts.backfill_menu_changes import backfill
+
+root_log = logging.getLogger()
+root_log.setLevel(logging.INFO)
+
+# Rows parsed and applied per transaction
+CHUNK_SIZE = 1000
+
+# Parser used inside each worker process
+_parser = BeerParser()
+
+
+def _parse_value(scraped_value):
+    """
+    Parse a single scraped value in a worker process.
+
+    :param scraped_value:
+    :type scraped_value: unicode
+    :return: Parsed beverage or None if parsing failed
+    :rtype: ScrapedBeverage
+    """
+    try:
+        return _parser.parse(scraped_value)
+    except ParsingException:
+        return None
+
+
+def _scrape_snapshot(args):
+    """
+    Re-scrape a stored menu snapshot in a worker process.
+
+    :param args: Chain name and snapshot digest
+    :type args: (str, str)
+    :return: Scraped beverages or None if the snapshot could not be scraped
+    :rtype: ScrapedBeverage[]
+    """
+    chain_name, digest = args
+    try:
+        return scrapers[chain_name]().scrape(snapshots.read(digest))
+    except Exception as e:
+        root_log.error('Unable to scrape snapshot {}. error={}'.format(digest, e))
+        return None
+
+
+def reparse_values(pool, chunk_size=CHUNK_SIZE, dry_run=False):
+    """
+    Re-parse BeverageScrape.scraped_value and re-link each scrape to the Beverage it now resolves to.
+
+    :param pool:
+    :type pool: multiprocessing.Pool
+    :param chunk_size:
+    :type chunk_size: int
+    :param dry_run: Report changes without saving them
+    :type dry_run: bool
+    :return: Number of scrapes read, re-linked and unparsable
+    :rtype: dict
+    """
+    stats = {'read': 0, 'relinked': 0, 'unparsable': 0}
+    relink = BeverageScrape.__table__.update() \
+        .where(BeverageScrape.__table__.c.id == bindparam('_id')) \
+        .values(beverage_id=bindparam('_beverage_id'))
+    locations = dict((x.id, x) for x in Location.query.all())
+    last_id = 0
+    while True:
+        rows = db.session.query(BeverageScrape.id, BeverageScrape.scraped_value, BeverageScrape.beverage_id,
+                                BeverageScrape.location_id) \
+            .filter(BeverageScrape.id > last_id, BeverageScrape.scraped_value != None) \
+            .order_by(BeverageScrape.id).limit(chunk_size).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        stats['read'] += len(rows)
+        parsed = pool.map(_parse_value, [x.scraped_value for x in rows], chunksize=max(1, len(rows) // 32))
+
+        # Resolve per location so new beverages are created at the location they were scraped from
+        by_location = {}
+        for row, scraped_beverage in zip(rows, parsed):
+            if scraped_beverage:
+                by_location.setdefault(row.location_id, []).append(scraped_beverage)
+        beverages = {}
+        for location_id, scraped_beverages in by_location.iteritems():
+            for key, beverage in resolve_beverages(scraped_beverages, locations.get(location_id)).iteritems():
+                beverages.setdefault(key, beverage)
+        db.session.flush()
+
+        changes = []
+        for row, scraped_beverage in zip(rows, parsed):
+            if not scraped_beverage:
+                stats['unparsable'] += 1
+                root_log.warn('Unable to parse BeverageScrape {}. scraped_value={}'.format(row.id, row.scraped_value))
+                continue
+            beverage = beverages[(scraped_beverage.name, scraped_beverage.brewery)]
+            if beverage.id != row.beverage_id:
+                root_log.info('BeverageScrape {} beverage {} -> {} "{}" - "{}"'.format(
+                    row.id, row.beverage_id, beverage.id, scraped_beverage.brewery, scraped_beverage.name))
+                changes.append({'_id': row.id, '_beverage_id': beverage.id})
+        stats['relinked'] += len(changes)
+        if changes:
+            db.session.execute(relink, changes)
+        _finish_chunk(dry_run)
+    return stats
+
+
+def reparse_snapshots(pool, chunk_size=CHUNK_SIZE, dry_run=False):
+    """
+    Re-scrape stored menu snapshots and rebuild the BeverageScrapes of any menu whose beverages changed.
+
+    :param pool:
+    :type pool: multiprocessing.Pool
+    :param chunk_size: Menus per chunk
+    :type chunk_size: int
+    :param dry_run: Report changes without saving them
+    :type dry_run: bool
+    :return: Number of menus read, rebuilt and unscrapable
+    :rtype: dict
+    """
+    stats = {'read': 0, 'rebuilt': 0, 'unscrapable': 0}
+    last_id = 0
+    while True:
+        menus = MenuScrape.query.filter(MenuScrape.id > last_id, MenuScrape.html_digest != None) \
+            .order_by(MenuScrape.id).limit(chunk_size).all()
+        if not menus:
+            break
+        last_id = menus[-1].id
+        stats['read'] += len(menus)
+        scraped = pool.map(_scrape_snapshot, [(x.location.chain.name, x.html_digest) for x in menus], chunksize=1)
+        for menu_scrape, scraped_beverages in zip(menus, scraped):
+            if scraped_beverages is None:
+                stats['unscrapable'] += 1
+                continue
+            beverages = resolve_beverages(scraped_beverages, menu_scrape.location)
+            db.session.flush()
+            old_ids = set(x.beverage_id for x in menu_scrape.beverage_scrapes)
+            new_ids = set(x.id for x in beverages.values())
+            if old_ids == new_ids:
+                continue
+            stats['rebuilt'] += 1
+            root_log.info('MenuScrape {} added beverages {} removed beverages {}'.format(
+                menu_scrape.id, sorted(new_ids - old_ids), sorted(old_ids - new_ids)))
+            for beverage_scrape in menu_scrape.beverage_scrapes:
+                db.session.delete(beverage_scrape)
+            for scraped_beverage in scraped_beverages:
+                db.session.add(BeverageScrape(beverage=beverages[(scraped_beverage.name, scraped_beverage.brewery)],
+                                              location=menu_scrape.location, menu_scrape=menu_scrape,
+                                              scraped_value=scraped_beverage.scraped_value,
+                                              created=menu_scrape.created))
+        _finish_chunk(dry_run)
+    return stats
+
+
+def _finish_chunk(dry_run):
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.commit()
+    # Loaded rows are not needed again, keep memory flat across chunks
+    db.session.expunge_all()
+
+
+if __name__ == '__main__':
+    # Setup logging
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_log.addHandler(sh)
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Re-parse historical beverage scrapes with the current parsers.')
+    parser.add_argument('--html', action='store_true', help='re-scrape stored menu snapshots instead of scraped values')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help='number of worker processes')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='rows applied per transaction')
+    parser.add_argument('--dry-run', action='store_true', help='report changes without saving them')
+    args = parser.parse_args()
+
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        if args.html:
+            result = reparse_snapshots(pool, args.chunk_size, args.dry_run)
+        else:
+            result = reparse_values(pool, args.chunk_size, args.dry_run)
+    finally:
+        pool.close()
+        pool.join()
+    if not args.dry_run:
+        backfill(rebuild=True)
+    root_log.info('Done. {}'.format(', '.join('{}={}'.format(k, v) for k, v in sorted(result.items()))))
@@ -0,0 +1,58 @@
+import logging
+from web import db
+
+root_log = logging.getLogger()
+
+
+def add_columns(table, columns):
+    """
+    Add columns to an existing SQLite table, skipping any that already exist so migrations can be re-run.
+
+    :param table: Table name
+    :type table: str
+    :param columns: Column name and SQL type pairs
+    :type columns: (str, str)[]
+    :return:
+    :rtype:
+    """
+    existing = [x['name'] for x in db.engine.execute('PRAGMA table_info({})'.format(table))]
+    for name, column_type in columns:
+        if name in existing:
+            root_log.info('Column {}.{} already exists'.format(table, name))
+            continue
+        db.engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, name, column_type))
+        root_log.info('Added column {}.{}'.format(table, name))
+
+
+def create_indexes(table):
+    """
+    Create the indexes declared on a model's table that an existing SQLite table is missing, so migrations can be
+    re-run.
+
+    :param table: Table name
+    :type table: str
+    :return:
+    :rtype:
+    """
+    existing = [x['name'] for x in db.engine.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?", (table,))]
+    for index in db.metadata.tables[table].indexes:
+        if index.name in existing:
+            root_log.info('Index {} already exists'.format(index.name))
+            continue
+        index.create(bind=db.engine)
+        root_log.info('Created index {}'.format(index.name))
+
+
+def query_plan(sql, params=()):
+    """
+    SQLite query plan of a statement.
+
+    :param sql:
+    :type sql: str
+    :param params: Values for the statement's placeholders
+    :type params: tuple
+    :return: Plan detail lines
+    :rtype: str[]
+    """
+    return [x['detail'] for x in db.engine.execute('EXPLAIN QUERY PLAN ' + sql, params)]
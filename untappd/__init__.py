@@ -5,12 +5,16 @@ log = logging.getLogger(__name__)
 
 import inspect
 import urllib
+import threading
 import time
 import sys
+from functools import partial
+from multiprocessing.pool import ThreadPool
 # 3rd party libraries that might not be present during initial install
 # but we need to import for the version #
 # try:
 import requests
+from untappd.scheduler import INTERACTIVE, BACKGROUND, Scheduler, backoff
 # except ImportError:
 # pass
 
@@ -44,10 +48,22 @@ MAX_MULTI_REQUESTS = 5
 # Change this if your Python distribution has issues with Untappd's SSL cert
 VERIFY_SSL = True
 
+# Number of hosts kept in the connection pool and keep-alive connections kept per host
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 10
+
+# Seconds to wait for a connection and for a response
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+# Seconds an interactive call waits for the rate limit before giving up
+INTERACTIVE_WAIT = 10
+
 
 class UntappdException(Exception): pass
 # Specific exceptions
 class InvalidParam(UntappdException): pass
+class RateLimitExceeded(UntappdException): pass
 
 #TODO: Add more error types
 error_types = {
@@ -55,17 +71,48 @@ error_types = {
 }
 
 
+def create_session(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE):
+    """
+    Creates a keep-alive session with a connection pool. Safe to share between Untappd instances and threads,
+    connections are reused across requests instead of paying for a new TCP and TLS handshake each time.
+    """
+    session = requests.Session()
+    # Retries are handled by _get
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                                            max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.verify = VERIFY_SSL
+    return session
+
+
 class Untappd(object):
-    def __init__(self, client_id=None, client_secret=None, access_token=None, redirect_uri=None):
-        self.oauth = self.OAuth(client_id, client_secret, redirect_uri)
-        self.base_requester = self.Requester(client_id, client_secret, access_token)
+    def __init__(self, client_id=None, client_secret=None, access_token=None, redirect_uri=None, session=None,
+                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), cache=None, scheduler=None, priority=INTERACTIVE):
+        """
+        :param session: Pooled session to make requests with, see create_session. A new one is created by default.
+        :param timeout: Seconds to wait for a connection and for a response
+        :param cache: Cache for GET responses, see untappd.cache. Nothing is cached by default.
+        :param scheduler: Rate limit scheduler, share one between all clients. Calls are not scheduled by default.
+        :param priority: INTERACTIVE for calls someone is waiting on, BACKGROUND for bulk jobs
+        """
+        self.base_requester = self.Requester(client_id, client_secret, access_token, session, timeout, cache,
+                                             scheduler, priority)
+        self.oauth = self.OAuth(client_id, client_secret, redirect_uri, self.base_requester)
         self._attach_endpoints()
 
-    def _attach_endpoints(self):
+    def _attach_endpoints(self, target=None, requester=None):
+        """Attach an instance of each endpoint to target, this client by default, making calls with requester"""
+        target = self if target is None else target
+        requester = self.base_requester if requester is None else requester
         for name, endpoint in inspect.getmembers(self):
             if inspect.isclass(endpoint) and issubclass(endpoint, self._Endpoint) and (endpoint is not self._Endpoint):
-                endpoint_instance = endpoint(self.base_requester)
-                setattr(self, endpoint_instance.endpoint, endpoint_instance)
+                endpoint_instance = endpoint(requester)
+                setattr(target, endpoint_instance.endpoint, endpoint_instance)
+
+    def multi(self):
+        """Collector for endpoint calls to make in batches, see Multi"""
+        return self.Multi(self, self.base_requester)
 
     def set_access_token(self, access_token):
         """Update the access token to use"""
@@ -84,10 +131,11 @@ class Untappd(object):
     class OAuth(object):
         """Handles OAuth authentication procedures and helps retrieve tokens"""
 
-        def __init__(self, client_id, client_secret, redirect_uri):
+        def __init__(self, client_id, client_secret, redirect_uri, requester=None):
             self.client_id = client_id
             self.client_secret = client_secret
             self.redirect_uri = redirect_uri
+            self.requester = requester
 
         def auth_url(self):
             """Gets the url a user needs to access to give up a user token"""
@@ -115,15 +163,72 @@ class Untappd(object):
                 'code': unicode(code),
             }
             # Get the response from the token uri and attempt to parse
-            return _get(TOKEN_ENDPOINT, params=params)['data']['response']['access_token']
+            session = self.requester.session if self.requester else None
+            timeout = self.requester.timeout if self.requester else None
+            return _get(TOKEN_ENDPOINT, params=params, session=session, timeout=timeout)['data']['response'][
+                'access_token']
+
+    class Multi(object):
+        """
+        Collects endpoint calls and makes them MAX_MULTI_REQUESTS at a time, like foursquare's multi requests.
+
+        Untappd has no multi endpoint, so the calls in each batch are made concurrently over the pooled session instead
+        of being sent in one request. A batch takes about as long as its slowest call. Every call still counts towards
+        the rate limit.
+
+            multi = untappd.multi()
+            for bid in bids:
+                multi.beer.info(bid)
+            for bid, result in zip(bids, multi):
+                if isinstance(result, UntappdException):
+                    ...
+        """
+
+        def __init__(self, untappd, requester):
+            self.requester = requester
+            self.requests = []
+            untappd._attach_endpoints(self, self)
+
+        def GET(self, path, *args, **kwargs):
+            """Collect a GET request"""
+            self.requests.append((self.requester.GET, path, args, kwargs))
+
+        def POST(self, path, *args, **kwargs):
+            """Collect a POST request"""
+            self.requests.append((self.requester.POST, path, args, kwargs))
+
+        def __len__(self):
+            return len(self.requests)
+
+        def __iter__(self):
+            """Make the collected calls, yields the response of each in order or the UntappdException it raised"""
+            pool = ThreadPool(MAX_MULTI_REQUESTS)
+            try:
+                while self.requests:
+                    batch = self.requests[:MAX_MULTI_REQUESTS]
+                    del self.requests[:MAX_MULTI_REQUESTS]
+                    results = [pool.apply_async(_call, request) for request in batch]
+                    for result in results:
+                        yield result.get()
+            finally:
+                pool.close()
 
     class Requester(object):
         """Api requesting object"""
 
-        def __init__(self, client_id=None, client_secret=None, access_token=None):
+        def __init__(self, client_id=None, client_secret=None, access_token=None, session=None,
+                     timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), cache=None, scheduler=None, priority=INTERACTIVE):
             """Sets up the api object"""
             self.client_id = client_id
             self.client_secret = client_secret
+            self.session = session or create_session()
+            self.timeout = timeout
+            self.cache = cache
+            self.scheduler = scheduler
+            self.priority = priority
+            # Cache keys being refreshed in the background
+            self._refreshing = set()
+            self._refreshing_lock = threading.Lock()
             self.set_token(access_token)
             self.rate_limit = None
             self.rate_remaining = None
@@ -134,7 +239,49 @@ class Untappd(object):
             self.userless = not bool(access_token)  # Userless if no access_token
 
         def GET(self, path, params={}, **kwargs):
-            """GET request that returns processed data"""
+            """GET request that returns processed data, from the cache if the endpoint is cacheable"""
+            ttl = self.cache.ttl(path) if self.cache else None
+            if not ttl:
+                return self._fetch(path, params)
+            key = self.cache.key(path, params)
+            cached = self.cache.get(key)
+            if cached:
+                response, stored = cached
+                age = time.time() - stored
+                if age < ttl:
+                    return response
+                if age < ttl + self.cache.stale_ttl:
+                    # Stale while revalidate
+                    self._refresh(key, path, params)
+                    return response
+            response = self._fetch(path, params)
+            self.cache.set(key, response)
+            return response
+
+        def _refresh(self, key, path, params):
+            """Refresh a cached response in the background, once at a time per key, at BACKGROUND priority"""
+            with self._refreshing_lock:
+                if key in self._refreshing:
+                    return
+                self._refreshing.add(key)
+
+            def refresh():
+                try:
+                    # Nobody waits on the refresh, it mustn't take calls kept for interactive ones
+                    self.cache.set(key, self._fetch(path, params, BACKGROUND))
+                except UntappdException:
+                    # Keep serving the stale response, already logged
+                    pass
+                finally:
+                    with self._refreshing_lock:
+                        self._refreshing.discard(key)
+
+            thread = threading.Thread(target=refresh)
+            thread.daemon = True
+            thread.start()
+
+        def _fetch(self, path, params, priority=None):
+            """GET request straight from the API, at the requester's priority unless given"""
             params = params.copy()
             # Continue processing normal requests
             headers = self._create_headers()
@@ -143,7 +290,8 @@ class Untappd(object):
                 API_ENDPOINT=API_ENDPOINT,
                 path=path
             )
-            result = _get(url, headers=headers, params=params)
+            result = _get(url, headers=headers, params=params, session=self.session, timeout=self.timeout,
+                          schedule=partial(self._schedule, priority=priority))
             self.rate_limit = result['headers']['X-RateLimit-Limit']
             self.rate_remaining = result['headers']['X-RateLimit-Remaining']
             return result['data']['response']
@@ -160,11 +308,25 @@ class Untappd(object):
                 API_ENDPOINT=API_ENDPOINT,
                 path=path
             )
-            result = _post(url, headers=headers, data=data, files=files)
+            result = _post(url, headers=headers, data=data, files=files, session=self.session, timeout=self.timeout,
+                           schedule=self._schedule)
             self.rate_limit = result['headers']['X-RateLimit-Limit']
             self.rate_remaining = result['headers']['X-RateLimit-Remaining']
             return result['data']['response']
 
+        def _schedule(self, headers=None, priority=None):
+            """Wait for the rate limit before a call, or record the limit reported in a response's headers"""
+            if not self.scheduler:
+                return
+            key = self.access_token or self.client_id
+            if headers is not None:
+                self.scheduler.update(key, headers)
+                return
+            priority = self.priority if priority is None else priority
+            timeout = INTERACTIVE_WAIT if priority == INTERACTIVE else None
+            if not self.scheduler.acquire(key, priority, timeout):
+                _log_and_raise_exception('Rate limit reached', 'waited {0}s'.format(timeout), RateLimitExceeded)
+
         def _enrich_params(self, params):
             """Enrich the params dict"""
             if self.userless:
@@ -263,6 +425,14 @@ class Untappd(object):
             return self.GET('view/{CHECKIN_ID}'.format(CHECKIN_ID=CHECKIN_ID), params)
 
 
+def _call(method, path, args, kwargs):
+    """Make a call, returning the UntappdException it raised instead of raising it"""
+    try:
+        return method(path, *args, **kwargs)
+    except UntappdException, e:
+        return e
+
+
 def _log_and_raise_exception(msg, data, cls=UntappdException):
     """Calls log.error() then raises an exception of class cls"""
     data = u'{0}'.format(data)
@@ -276,31 +446,44 @@ def _log_and_raise_exception(msg, data, cls=UntappdException):
 Network helper functions
 """
 #def _request_with_retry(url, headers={}, data=None):
-def _get(url, headers={}, params=None):
-    """Tries to GET data from an endpoint using retries"""
+def _get(url, headers={}, params=None, session=None, timeout=None, schedule=None):
+    """
+    Tries to GET data from an endpoint using retries with exponential backoff, with a pooled session if one is given.
+    schedule is called before each try and with the headers of each response, see Requester._schedule.
+    """
     #TODO: make sure we don't need silly foursquare urlencoding
     # param_string = _foursquare_urlencode(params)
     param_string = urllib.urlencode(params)
     for i in xrange(NUM_REQUEST_RETRIES):
         try:
             try:
-                response = requests.get(url, headers=headers, params=param_string, verify=VERIFY_SSL)
+                if schedule:
+                    schedule()
+                response = (session or requests).get(url, headers=headers, params=param_string, verify=VERIFY_SSL,
+                                                     timeout=timeout)
+                if schedule:
+                    schedule(response.headers)
                 return _process_response(response)
             except requests.exceptions.RequestException, e:
                 _log_and_raise_exception('Error connecting with foursquare API', e)
         except UntappdException, e:
             # Some errors don't bear repeating
-            if e.__class__ in [InvalidParam]: raise
+            if e.__class__ in [InvalidParam, RateLimitExceeded]: raise
             # if e.__class__ in [InvalidAuth, ParamError, EndpointError, NotAuthorized, Deprecated]: raise
             # If we've reached our last try, re-raise
             if ((i + 1) == NUM_REQUEST_RETRIES): raise
-        time.sleep(1)
+        time.sleep(backoff(i))
 
 
-def _post(url, headers={}, data=None, files=None):
-    """Tries to POST data to an endpoint"""
+def _post(url, headers={}, data=None, files=None, session=None, timeout=None, schedule=None):
+    """Tries to POST data to an endpoint, with a pooled session if one is given"""
     try:
-        response = requests.post(url, headers=headers, data=data, files=files, verify=VERIFY_SSL)
+        if schedule:
+            schedule()
+        response = (session or requests).post(url, headers=headers, data=data, files=files, verify=VERIFY_SSL,
+                                              timeout=timeout)
+        if schedule:
+            schedule(response.headers)
         return _process_response(response)
     except requests.exceptions.RequestException, e:
         _log_and_raise_exception('Error connecting with foursquare API', e)
@@ -0,0 +1,67 @@
+""" Concurrent variant of the Untappd client, endpoint calls return right away with a result to wait on """
+from multiprocessing.pool import ThreadPool
+from untappd import Untappd, create_session, POOL_MAXSIZE
+
+# Calls in flight at once per client
+DEFAULT_CONCURRENCY = 8
+
+
+class AsyncUntappd(Untappd):
+    """
+    Untappd client whose endpoint calls run on a bounded pool of threads so their network waits overlap.
+
+    Endpoints are the same as Untappd's but return a multiprocessing.pool.AsyncResult, result.get() waits for the
+    response and raises the same exceptions. OAuth calls are still made synchronously.
+
+        with AsyncUntappd(client_id, client_secret, concurrency=10) as untappd:
+            results = [untappd.beer.info(bid) for bid in bids]
+            beers = [result.get() for result in results]
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Takes the same arguments as Untappd, and:
+
+        :param concurrency: Calls in flight at once, calls past that are queued
+        """
+        concurrency = kwargs.pop('concurrency', DEFAULT_CONCURRENCY)
+        if not kwargs.get('session'):
+            # Enough keep-alive connections for every call in flight
+            kwargs['session'] = create_session(pool_maxsize=max(POOL_MAXSIZE, concurrency))
+        super(AsyncUntappd, self).__init__(*args, **kwargs)
+        self.pool = ThreadPool(concurrency)
+        self.base_requester = self.AsyncRequester(self.base_requester, self.pool)
+        self._attach_endpoints()
+
+    def multi(self):
+        """Collector for endpoint calls to make in batches, responses are returned as they are by Untappd.multi"""
+        return self.Multi(self, self.base_requester.requester)
+
+    def close(self):
+        """Wait for calls in flight and stop the pool's threads"""
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    class AsyncRequester(object):
+        """Runs a Requester's calls on a thread pool, everything else is passed through to the Requester"""
+
+        def __init__(self, requester, pool):
+            self.requester = requester
+            self.pool = pool
+
+        def __getattr__(self, name):
+            return getattr(self.requester, name)
+
+        def GET(self, path, *args, **kwargs):
+            """GET request in the background, returns an AsyncResult"""
+            return self.pool.apply_async(self.requester.GET, (path,) + args, kwargs)
+
+        def POST(self, path, *args, **kwargs):
+            """POST request in the background, returns an AsyncResult"""
+            return self.pool.apply_async(self.requester.POST, (path,) + args, kwargs)
@@ -0,0 +1,133 @@
+""" Response caches for Untappd API calls, see Untappd(cache=...) """
+import json
+import sqlite3
+import threading
+import time
+import urllib
+from abc import abstractmethod
+from collections import OrderedDict
+
+# Seconds a response stays fresh, by endpoint path prefix. Endpoints not listed are never cached.
+DEFAULT_TTLS = {
+    '/beer/info/': 24 * 60 * 60,
+    '/brewery/info/': 7 * 24 * 60 * 60,
+    '/venue/info/': 24 * 60 * 60,
+    '/user/info/': 60 * 60,
+}
+
+# Seconds past its TTL a stale response is still returned while it is refreshed in the background
+STALE_TTL = 24 * 60 * 60
+
+# Max responses kept
+MAX_ENTRIES = 10000
+
+# Seconds a stored response's last access time may lag, so most cache hits don't have to write
+ACCESS_GRANULARITY = 60
+
+# Params that identify the caller, not the request
+CREDENTIAL_PARAMS = ('access_token', 'client_id', 'client_secret')
+
+
+class Cache(object):
+    """Base response cache, decides what is cached and for how long"""
+
+    def __init__(self, ttls=None, stale_ttl=STALE_TTL, max_entries=MAX_ENTRIES):
+        self.ttls = DEFAULT_TTLS if ttls is None else ttls
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+
+    def ttl(self, path):
+        """Seconds a response for the path stays fresh, None if it should not be cached"""
+        for prefix, ttl in self.ttls.iteritems():
+            # Paths without an ID, e.g. /user/info/, depend on the access token
+            if path.startswith(prefix) and len(path) > len(prefix):
+                return ttl
+        return None
+
+    def key(self, path, params):
+        """Cache key of a request, the same for every user"""
+        params = sorted((k, v) for k, v in params.iteritems() if k not in CREDENTIAL_PARAMS)
+        return '{0}?{1}'.format(path, urllib.urlencode(params))
+
+    @abstractmethod
+    def get(self, key):
+        """Cached response and the time it was stored, None if not cached"""
+
+    @abstractmethod
+    def set(self, key, response):
+        """Store a response, evicting the least recently used ones past max_entries"""
+
+
+class MemoryCache(Cache):
+    """Cache held in memory, for a single process. Responses are kept serialized so callers each get their own copy."""
+
+    def __init__(self, ttls=None, stale_ttl=STALE_TTL, max_entries=MAX_ENTRIES):
+        super(MemoryCache, self).__init__(ttls, stale_ttl, max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            # Most recently used entries are kept at the end
+            self._entries[key] = entry
+        return json.loads(entry[0]), entry[1]
+
+    def set(self, key, response):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (json.dumps(response), time.time())
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteCache(Cache):
+    """
+    Cache stored in a SQLite file, survives restarts and is shared between processes. Least recently used is tracked to
+    within ACCESS_GRANULARITY.
+    """
+
+    def __init__(self, path, ttls=None, stale_ttl=STALE_TTL, max_entries=MAX_ENTRIES):
+        super(SQLiteCache, self).__init__(ttls, stale_ttl, max_entries)
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS response ('
+                               'key TEXT PRIMARY KEY, data TEXT, stored REAL, accessed REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_response_accessed ON response (accessed)')
+
+    def _connection(self):
+        # SQLite connections can't be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path, timeout=10)
+        return connection
+
+    def get(self, key):
+        with self._connection() as connection:
+            row = connection.execute('SELECT data, stored, accessed FROM response WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - row[2] >= ACCESS_GRANULARITY:
+                connection.execute('UPDATE response SET accessed = ? WHERE key = ?', (now, key))
+        return json.loads(row[0]), row[1]
+
+    def set(self, key, response):
+        now = time.time()
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO response (key, data, stored, accessed) VALUES (?, ?, ?, ?)',
+                               (key, json.dumps(response), now, now))
+            connection.execute('DELETE FROM response WHERE key IN '
+                               '(SELECT key FROM response ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                               (self.max_entries,))
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM response')
@@ -0,0 +1,162 @@
+""" Rate limit budgeting for Untappd API calls, see Untappd(scheduler=...) """
+import random
+import threading
+import time
+from collections import deque
+
+# Call priorities, interactive calls are made for someone waiting on a page
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Calls allowed per access token, or per client without one, in each window. Untappd reports the limit with every
+# response but not the window.
+RATE_LIMIT = 100
+RATE_WINDOW = 60 * 60
+
+# Fraction of each window's calls background jobs may not use, kept for interactive calls
+BACKGROUND_RESERVE = 0.2
+
+# Minimum seconds between background calls with the same credentials
+BACKGROUND_SPACING = 1.0
+
+# Retry backoff, seconds to wait at most before the first retry and before any retry
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+
+def backoff(attempt, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    """Seconds to wait before retrying, exponential with full jitter so retrying clients spread out"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class Scheduler(object):
+    """
+    Decides when API calls may be made so the rate limit is never hit.
+
+    Calls are counted over a sliding window for each set of credentials, together with the remaining calls Untappd
+    last reported. Background calls are spaced out and stop short of the limit, leaving a reserve for interactive
+    calls, and wait while any interactive call is waiting. Safe to share between threads and Untappd instances.
+
+    The budget is kept in memory, so it's only shared within a process. Calls made by other processes with the same
+    credentials, e.g. the web app and a job worker, only show up in the remaining calls Untappd reports with the next
+    response. A process never waits on another's interactive calls, and the reserve can be used up by calls made
+    elsewhere since the last response.
+    """
+
+    def __init__(self, limit=RATE_LIMIT, window=RATE_WINDOW, reserve=BACKGROUND_RESERVE, spacing=BACKGROUND_SPACING):
+        self.limit = limit
+        self.window = window
+        self.reserve = reserve
+        self.spacing = spacing
+        self._budgets = {}
+        self._condition = threading.Condition()
+
+    def acquire(self, key, priority=INTERACTIVE, timeout=None):
+        """
+        Wait until a call may be made and count it.
+
+        :param key: Credentials the call is made with, an access token or client ID
+        :param priority: INTERACTIVE or BACKGROUND
+        :param timeout: Seconds to wait at most, forever by default
+        :return: False if the call could not be made in time
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._condition:
+            budget = self._budget(key, time.time())
+            if priority == INTERACTIVE:
+                budget.interactive_waiting += 1
+            try:
+                while True:
+                    now = time.time()
+                    budget.expire(now)
+                    wait = budget.wait(now, priority)
+                    if wait <= 0:
+                        budget.spend(now, priority)
+                        return True
+                    if deadline is not None:
+                        if now + wait > deadline:
+                            return False
+                    self._condition.wait(wait)
+            finally:
+                if priority == INTERACTIVE:
+                    budget.interactive_waiting -= 1
+                    # Background calls may be able to go now
+                    self._condition.notify_all()
+
+    def update(self, key, headers):
+        """Record the rate limit Untappd reported in a response's headers"""
+        try:
+            limit = int(headers['X-RateLimit-Limit'])
+            remaining = int(headers['X-RateLimit-Remaining'])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self._condition:
+            self._budget(key, time.time()).report(limit, remaining)
+            self._condition.notify_all()
+
+    def _budget(self, key, now):
+        budget = self._budgets.get(key)
+        if budget is None:
+            budget = self._budgets[key] = _Budget(self)
+        budget.expire(now)
+        return budget
+
+
+class _Budget(object):
+    """Calls made with one set of credentials"""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.limit = scheduler.limit
+        # Times of calls made in the current window
+        self.calls = deque()
+        # Remaining calls Untappd reported, less the calls made since, and when it was reported
+        self.remaining = None
+        self.reported = None
+        self.next_background = 0
+        self.interactive_waiting = 0
+
+    def expire(self, now):
+        window = self.scheduler.window
+        while self.calls and self.calls[0] <= now - window:
+            self.calls.popleft()
+        if self.reported is not None and self.reported <= now - window:
+            # The reported window has reset
+            self.remaining = None
+            self.reported = None
+
+    def report(self, limit, remaining):
+        self.limit = limit
+        self.remaining = remaining
+        self.reported = time.time()
+
+    def available(self):
+        available = self.limit - len(self.calls)
+        if self.remaining is not None:
+            available = min(available, self.remaining)
+        return available
+
+    def wait(self, now, priority):
+        """Seconds until a call may be made, 0 or less if it may be made now"""
+        # When the oldest call or the reported window leaves the window, whichever frees up a call first
+        window = self.scheduler.window
+        frees = []
+        if self.calls:
+            frees.append(self.calls[0] + window - now)
+        if self.reported is not None:
+            frees.append(self.reported + window - now)
+        free_wait = min(frees) if frees else window
+        if priority == INTERACTIVE:
+            return 0 if self.available() > 0 else free_wait
+        if self.interactive_waiting:
+            return free_wait
+        if self.available() <= int(self.limit * self.scheduler.reserve):
+            return free_wait
+        return self.next_background - now
+
+    def spend(self, now, priority):
+        self.calls.append(now)
+        if self.remaining is not None:
+            self.remaining -= 1
+        if priority == BACKGROUND:
+            self.next_background = now + self.scheduler.spacing
@@ -0,0 +1,59 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+from untappd.cache import SQLiteCache, ACCESS_GRANULARITY
+import logging
+
+root_log = logging.getLogger()
+root_log.setLevel(logging.WARN)
+root_log.addHandler(logging.NullHandler())
+
+
+class TestSQLiteCache(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = SQLiteCache(os.path.join(self.root, 'cache.db'), max_entries=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def accessed(self, key):
+        return self.cache._connection().execute('SELECT accessed FROM response WHERE key = ?', (key,)).fetchone()[0]
+
+    def age(self, key, seconds):
+        with self.cache._connection() as connection:
+            connection.execute('UPDATE response SET accessed = accessed - ? WHERE key = ?', (seconds, key))
+
+    def test_round_trip(self):
+        """ Test a stored response reads back with the time it was stored """
+        self.cache.set('a', {'beer': 1})
+        response, stored = self.cache.get('a')
+        self.assertEqual({'beer': 1}, response)
+        self.assertAlmostEqual(time.time(), stored, delta=5)
+        self.assertIsNone(self.cache.get('b'))
+
+    def test_recent_hit_read_only(self):
+        """ Test a hit on a recently accessed response doesn't write """
+        self.cache.set('a', {'beer': 1})
+        connection = self.cache._connection()
+        changes = connection.total_changes
+        self.cache.get('a')
+        self.assertEqual(changes, connection.total_changes)
+
+    def test_least_recently_used(self):
+        """ Test a hit on a response not accessed within the granularity keeps it from being evicted """
+        self.cache.set('a', {'beer': 1})
+        self.cache.set('b', {'beer': 2})
+        self.age('a', 2 * ACCESS_GRANULARITY)
+        self.age('b', 3 * ACCESS_GRANULARITY)
+        self.cache.get('b')
+        self.assertAlmostEqual(time.time(), self.accessed('b'), delta=5)
+        self.cache.set('c', {'beer': 3})
+        self.assertIsNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('b'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import unittest
+import json
+import threading
+import time
+import untappd
+from untappd import Untappd
+from untappd.cache import MemoryCache
+from untappd.scheduler import Scheduler, INTERACTIVE, BACKGROUND
+import logging
+
+root_log = logging.getLogger()
+root_log.setLevel(logging.WARN)
+root_log.addHandler(logging.NullHandler())
+
+
+class TestScheduler(unittest.TestCase):
+    def acquired(self, scheduler, priority, calls, key='token'):
+        return sum(1 for i in range(calls) if scheduler.acquire(key, priority, 0))
+
+    def test_background_reserve(self):
+        """ Test that background calls leave the reserve to interactive calls """
+        scheduler = Scheduler(limit=10, window=60, reserve=0.2, spacing=0)
+        self.assertEqual(8, self.acquired(scheduler, BACKGROUND, 10))
+        self.assertEqual(2, self.acquired(scheduler, INTERACTIVE, 10))
+        self.assertEqual(10, self.acquired(scheduler, INTERACTIVE, 20, 'other token'))
+
+    def test_background_spacing(self):
+        """ Test that background calls are spaced out and interactive calls are not """
+        scheduler = Scheduler(limit=10, window=60, reserve=0, spacing=0.2)
+        self.assertEqual(1, self.acquired(scheduler, BACKGROUND, 3))
+        self.assertEqual(3, self.acquired(scheduler, INTERACTIVE, 3))
+        time.sleep(0.2)
+        self.assertEqual(1, self.acquired(scheduler, BACKGROUND, 3))
+
+    def test_window(self):
+        """ Test that calls are allowed again once the earlier ones leave the window """
+        scheduler = Scheduler(limit=2, window=0.2, reserve=0, spacing=0)
+        self.assertEqual(2, self.acquired(scheduler, INTERACTIVE, 3))
+        self.assertTrue(scheduler.acquire('token', INTERACTIVE, 1))
+
+    def test_interactive_first(self):
+        """ Test that a waiting interactive call goes before a background call waiting longer """
+        scheduler = Scheduler(limit=2, window=0.5, reserve=0, spacing=0)
+        self.assertEqual(2, self.acquired(scheduler, INTERACTIVE, 2))
+        order = []
+
+        def call(priority):
+            scheduler.acquire('token', priority)
+            order.append(priority)
+
+        background = threading.Thread(target=call, args=(BACKGROUND,))
+        background.start()
+        time.sleep(0.1)
+        interactive = threading.Thread(target=call, args=(INTERACTIVE,))
+        interactive.start()
+        background.join()
+        interactive.join()
+        self.assertEqual([INTERACTIVE, BACKGROUND], order)
+
+    def test_reported_remaining(self):
+        """ Test that calls stop at the remaining calls Untappd reported until its window resets """
+        scheduler = Scheduler(limit=10, window=0.3, reserve=0.2, spacing=0)
+        scheduler.update('token', {'X-RateLimit-Limit': '10', 'X-RateLimit-Remaining': '3'})
+        self.assertEqual(1, self.acquired(scheduler, BACKGROUND, 3))
+        self.assertEqual(2, self.acquired(scheduler, INTERACTIVE, 3))
+        time.sleep(0.3)
+        self.assertEqual(10, self.acquired(scheduler, INTERACTIVE, 20))
+
+    def test_unreported_headers(self):
+        """ Test that responses without rate limit headers leave the budget alone """
+        scheduler = Scheduler(limit=2, window=60, reserve=0, spacing=0)
+        scheduler.update('token', {})
+        scheduler.update('token', {'X-RateLimit-Limit': '10', 'X-RateLimit-Remaining': None})
+        self.assertEqual(2, self.acquired(scheduler, INTERACTIVE, 3))
+
+
+
+class RecordingScheduler(Scheduler):
+    """ Lets every call through, recording its priority """
+
+    def __init__(self):
+        super(RecordingScheduler, self).__init__()
+        self.priorities = []
+
+    def acquire(self, key, priority=INTERACTIVE, timeout=None):
+        self.priorities.append(priority)
+        return True
+
+
+class TestRequesterPriority(unittest.TestCase):
+    def setUp(self):
+        self.get = untappd._get
+        untappd._get = self.fake_get
+        self.scheduler = RecordingScheduler()
+        self.cache = MemoryCache({'/beer/info/': 60})
+        self.client = Untappd('id', 'secret', cache=self.cache, scheduler=self.scheduler)
+
+    def tearDown(self):
+        untappd._get = self.get
+
+    def fake_get(self, url, headers={}, params=None, session=None, timeout=None, schedule=None):
+        schedule()
+        headers = {'X-RateLimit-Limit': '100', 'X-RateLimit-Remaining': '99'}
+        schedule(headers)
+        return {'headers': headers, 'data': {'response': {'beer': 'fetched'}}}
+
+    def test_interactive(self):
+        """ Test that a call someone waits on is made at the client's priority """
+        self.assertEqual({'beer': 'fetched'}, self.client.beer.info(1))
+        self.assertEqual([INTERACTIVE], self.scheduler.priorities)
+
+    def test_stale_refresh(self):
+        """ Test that a stale response is refreshed in the background at BACKGROUND priority """
+        key = self.cache.key('/beer/info/1', {})
+        self.cache._entries[key] = (json.dumps({'beer': 'stale'}), time.time() - 120)
+        self.assertEqual({'beer': 'stale'}, self.client.beer.info(1))
+        for i in range(100):
+            if self.cache.get(key)[0] == {'beer': 'fetched'}:
+                break
+            time.sleep(0.01)
+        self.assertEqual({'beer': 'fetched'}, self.cache.get(key)[0])
+        self.assertEqual([BACKGROUND], self.scheduler.priorities)
+
+
+if __name__ == '__main__':
+    unittest.main()
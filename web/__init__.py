@@ -1,3 +1,4 @@
+import os
 from flask import Flask
 from flask.ext.sqlalchemy import SQLAlchemy
 from flask_debugtoolbar import DebugToolbarExtension
@@ -8,6 +9,13 @@ app.config['SECRET_KEY'] = 'lkadfsnr12h7fnadvwnaseb80b0^*)g0v680v680b780bS*DFB7s
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 #TODO Move db file to better place
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///drink_different.db'
+# Compressed raw HTML of every scraped menu
+app.config['SNAPSHOT_DIR'] = os.path.join(app.root_path, 'snapshots')
+app.config['UNTAPPD_CLIENT_ID'] = '04513C89D24C72DD55C71441835D7BF4FF70077E'
+app.config['UNTAPPD_CLIENT_SECRET'] = '02D05C33B6152E3BC9183ECB5BE58DF289D47457'
+app.config['UNTAPPD_REDIRECT_URI'] = 'http://127.0.0.1:5000/auth'
+# Cached Untappd API responses
+app.config['UNTAPPD_CACHE'] = os.path.join(app.root_path, 'untappd_cache.db')
 db = SQLAlchemy(app)
 
 toolbar = DebugToolbarExtension(app)
@@ -0,0 +1,133 @@
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from web import db
+from models import DistinctBeer
+
+# Users whose consumed beers are kept in memory, the least recently used are dropped past this
+CONSUMED_CACHE_SIZE = 200
+
+
+class ConsumedBids(object):
+    """
+    Untappd beer IDs a user has consumed, as a sorted array of 4 byte integers. Checking a beer is a binary search.
+    """
+
+    def __init__(self, bids, synced_at=None):
+        """
+        :param bids: Sorted Untappd beer IDs
+        :type bids: int[]
+        :param synced_at: User's distinct_synced_at when the IDs were read
+        :type synced_at: datetime
+        """
+        self.bids = array('i', bids)
+        self.synced_at = synced_at
+
+    def __contains__(self, bid):
+        # Beverage.untappd_id is a string
+        try:
+            bid = int(bid)
+        except (TypeError, ValueError):
+            return False
+        i = bisect_left(self.bids, bid)
+        return i < len(self.bids) and self.bids[i] == bid
+
+    def __len__(self):
+        return len(self.bids)
+
+
+class ConsumedCache(object):
+    """
+    Bounded LRU cache of each user's ConsumedBids, built the first time a user is checked.
+
+    An entry is rebuilt when the user's distinct_synced_at no longer matches it, so a sync in another process is picked
+    up the next time the user is loaded. Syncs in this process also invalidate the entry directly.
+    """
+
+    def __init__(self, size=CONSUMED_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user):
+        """
+        :param user:
+        :type user: User
+        :return:
+        :rtype: ConsumedBids
+        """
+        with self._lock:
+            consumed = self._entries.pop(user.id, None)
+            if consumed is not None and consumed.synced_at == user.distinct_synced_at:
+                # Most recently used entries are kept at the end
+                self._entries[user.id] = consumed
+                return consumed
+        consumed = load_consumed(user)
+        with self._lock:
+            self._entries[user.id] = consumed
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return consumed
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def load_consumed(user):
+    """
+    Read a user's consumed Untappd beer IDs, in order from the user_id, untappd_bid index.
+
+    :param user:
+    :type user: User
+    :return:
+    :rtype: ConsumedBids
+    """
+    bids = db.session.query(DistinctBeer.untappd_bid).filter(
+        DistinctBeer.user_id == user.id,
+        DistinctBeer.untappd_bid != None
+    ).order_by(DistinctBeer.untappd_bid)
+    return ConsumedBids((x for x, in bids), user.distinct_synced_at)
+
+
+consumed_cache = ConsumedCache()
+
+
+def split_consumed(query, user):
+    """
+    Split beverages into the ones a user has and has not consumed.
+
+    Checked against the user's cached consumed beers, beverages without an Untappd ID are unconsumed.
+
+    :param query: Beverages to split
+    :type query: sqlalchemy.orm.Query
+    :param user: User to check against, all beverages are unconsumed without one
+    :type user: User|None
+    :return: Consumed and unconsumed beverages
+    :rtype: (Beverage[], Beverage[])
+    """
+    beverages = query.all()
+    if not user:
+        return [], beverages
+    consumed = consumed_cache.get(user)
+    return [x for x in beverages if x.untappd_id in consumed], [x for x in beverages if x.untappd_id not in consumed]
+
+
+def consumed_bids(user, bids):
+    """
+    Untappd beer IDs a user has consumed out of the given ones, checked against the user's cached consumed beers.
+
+    :param user:
+    :type user: User
+    :param bids: Untappd beer IDs
+    :type bids: int[]
+    :return:
+    :rtype: set
+    """
+    consumed = consumed_cache.get(user)
+    return set(x for x in bids if x in consumed)
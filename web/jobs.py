@@ -0,0 +1,287 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy.sql import or_, and_
+from web import db
+from models import Job, Location, User
+from sync import sync_distinct_beers
+from untappd import BACKGROUND
+
+_log = logging.getLogger(__name__)
+
+# Seconds a running job may go without a sign of life before it's taken to be abandoned by a dead worker and re-run
+STALE_AFTER = 15 * 60
+# Seconds between the signs of life a worker gives while its job runs, whether or not the job reports progress
+HEARTBEAT_INTERVAL = 60
+# Seconds between progress writes, so progress doesn't write on every step
+PROGRESS_INTERVAL = 2
+# Seconds an idle worker waits before looking for jobs again
+POLL_INTERVAL = 5
+# Lines of a script's output kept as the job result
+SCRIPT_OUTPUT_LINES = 20
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS_DIR = os.path.join(PACKAGE_DIR, 'scripts')
+
+
+def job_key(type, args):
+    """
+    Identity of a job, identical jobs are deduplicated.
+
+    :param type: Job type
+    :type type: str
+    :param args: Handler keyword arguments
+    :type args: dict
+    :return:
+    :rtype: str
+    """
+    return hashlib.sha1(json.dumps([type, args], sort_keys=True)).hexdigest()
+
+
+def enqueue(type, **args):
+    """
+    Queue a job, unless an identical one is already waiting or running.
+
+    The check and insert are a single statement so concurrent requests can't queue the same job twice.
+
+    :param type: Job type, one of handlers
+    :type type: str
+    :param args: Handler keyword arguments, must be JSON serializable
+    :return: The queued job or the identical one
+    :rtype: Job
+    """
+    if type not in handlers:
+        raise ValueError('Unknown job type {}'.format(type))
+    key = job_key(type, args)
+    now = datetime.now()
+    db.session.execute(
+        'INSERT INTO job (type, args, key, state, progress, attempts, created, updated) '
+        'SELECT :type, :args, :key, :pending, 0, 0, :now, :now '
+        'WHERE NOT EXISTS (SELECT 1 FROM job WHERE key = :key AND state IN (:pending, :running))',
+        {'type': type, 'args': json.dumps(args, sort_keys=True), 'key': key, 'now': now, 'pending': Job.PENDING,
+         'running': Job.RUNNING})
+    db.session.commit()
+    return Job.query.filter(Job.key == key, Job.state.in_([Job.PENDING, Job.RUNNING])).order_by(Job.id.desc()).first()
+
+
+def claim(worker):
+    """
+    Take the oldest waiting job, or a running job whose worker stopped showing signs of life.
+
+    A claim only succeeds if no other worker claimed the job since it was read, checked by the number of attempts.
+
+    :param worker: Name of the claiming worker
+    :type worker: str
+    :return: The claimed job, None if there are no jobs to run
+    :rtype: Job
+    """
+    while True:
+        now = datetime.now()
+        job = Job.query.filter(or_(
+            Job.state == Job.PENDING,
+            and_(Job.state == Job.RUNNING, Job.updated < now - timedelta(seconds=STALE_AFTER))
+        )).order_by(Job.id).first()
+        if not job:
+            db.session.commit()
+            return None
+        claimed = db.session.execute(Job.__table__.update().where(and_(
+            Job.id == job.id,
+            Job.attempts == job.attempts
+        )).values(state=Job.RUNNING, worker=worker, attempts=job.attempts + 1, started=now, updated=now))
+        db.session.commit()
+        db.session.refresh(job)
+        if claimed.rowcount == 1:
+            # Identifies this claim once the job is claimed again by another worker
+            job.attempt = job.attempts
+            return job
+
+
+def owned(job):
+    """
+    Condition matching a job only while it's still held by the claim that returned it, see claim.
+
+    :param job: Claimed job
+    :type job: Job
+    :return:
+    :rtype: sqlalchemy.sql.expression.BinaryExpression
+    """
+    return and_(Job.id == job.id, Job.attempts == job.attempt)
+
+
+def run(job):
+    """
+    Run a claimed job with its handler and record how it finished.
+
+    A heartbeat keeps the job from going stale while the handler runs, even if the handler never reports progress. The
+    result is discarded if the job was claimed again by another worker in the meantime.
+
+    :param job: Claimed job
+    :type job: Job
+    :return: False if the job was claimed again and its result discarded
+    :rtype: bool
+    """
+    _log.info('Running {}'.format(job))
+    heartbeat = Heartbeat(job)
+    heartbeat.start()
+    try:
+        result = handlers[job.type](job, **json.loads(job.args))
+        state = Job.DONE
+    except Exception as e:
+        db.session.rollback()
+        _log.exception('Job {} failed'.format(job.id))
+        result = '{}: {}'.format(e.__class__.__name__, e)
+        state = Job.FAILED
+    finally:
+        heartbeat.stop()
+    now = datetime.now()
+    values = {'state': state, 'result': result, 'finished': now, 'updated': now}
+    if getattr(job, 'unreported', None):
+        # Progress report skipped for being too soon after the one before
+        values['progress'], values['total'] = job.unreported
+    finished = db.session.execute(Job.__table__.update().where(owned(job)).values(**values))
+    db.session.commit()
+    if finished.rowcount != 1:
+        _log.warning('Job {} was claimed again by another worker, its result is discarded'.format(job.id))
+        return False
+    _log.info('Finished {}'.format(job))
+    return True
+
+
+class Heartbeat(threading.Thread):
+    """
+    Marks a claimed job as alive every HEARTBEAT_INTERVAL until stopped, on its own connection.
+    """
+
+    def __init__(self, job, interval=HEARTBEAT_INTERVAL):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+        self.condition = owned(job)
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                db.engine.execute(Job.__table__.update().where(self.condition).values(updated=datetime.now()))
+            except Exception:
+                # e.g. the database is locked by the job, try again next beat
+                _log.warning('Heartbeat failed', exc_info=True)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def report(job, progress=None, total=None):
+    """
+    Record a running job's progress, which is also a sign of life. Written at most every PROGRESS_INTERVAL, except once
+    the work is done. Progress that isn't written is written when the job finishes, see run.
+
+    :param job:
+    :type job: Job
+    :param progress: Work done
+    :type progress: int
+    :param total: Total work, if known
+    :type total: int
+    :return:
+    :rtype:
+    """
+    now = datetime.now()
+    progress = progress if progress is not None else job.progress
+    total = total if total is not None else job.total
+    job.unreported = (progress, total)
+    done = total is not None and progress == total
+    if not done and job.updated and now - job.updated < timedelta(seconds=PROGRESS_INTERVAL):
+        return
+    db.session.execute(Job.__table__.update().where(owned(job)).values(progress=progress, total=total, updated=now))
+    db.session.commit()
+    db.session.refresh(job)
+    job.unreported = None
+
+
+def work(worker, once=False, poll=POLL_INTERVAL):
+    """
+    Claim and run jobs until stopped.
+
+    :param worker: Name of this worker
+    :type worker: str
+    :param once: Stop when there are no jobs left instead of waiting for more
+    :type once: bool
+    :param poll: Seconds to wait between looking for jobs when idle
+    :type poll: int
+    :return:
+    :rtype:
+    """
+    while True:
+        job = claim(worker)
+        if job:
+            run(job)
+        elif once:
+            return
+        else:
+            time.sleep(poll)
+
+
+def scripts():
+    """
+    Maintenance scripts that can be run as jobs.
+
+    :return: Module names in scripts/
+    :rtype: str[]
+    """
+    return sorted(x[:-3] for x in os.listdir(SCRIPTS_DIR)
+                  if x.endswith('.py') and not x.startswith('_') and x not in ('util.py', 'job_worker.py'))
+
+
+def sync_distinct(job, user_id):
+    """Sync a user's distinct beers from Untappd"""
+    from views import untappd_client
+    user = User.query.get(user_id)
+    if not user:
+        raise ValueError('No user {}'.format(user_id))
+    added = sync_distinct_beers(user, untappd_client(user.access_token, BACKGROUND),
+                                lambda progress, total: report(job, progress, total))
+    return 'Added {} distinct beers'.format(added)
+
+
+def scrape_location(job, location_id):
+    """Scrape a location's menu"""
+    # The scraper imports the web app
+    from scraper.scrape import scrape_location, scraper_for
+    location = Location.query.get(location_id)
+    if not location:
+        raise ValueError('No location {}'.format(location_id))
+    scrape_location(location, scraper_for(location))
+    return 'Scraped {}'.format(location.name)
+
+
+def run_script(job, name, args=()):
+    """Run a maintenance script in its own interpreter, progress is lines of output and the result is the last lines"""
+    if name not in scripts():
+        raise ValueError('Unknown script {}'.format(name))
+    process = subprocess.Popen([sys.executable, '-m', 'scripts.{}'.format(name)] + list(args), cwd=PACKAGE_DIR,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = collections.deque(maxlen=SCRIPT_OUTPUT_LINES)
+    lines = 0
+    for line in iter(process.stdout.readline, ''):
+        output.append(line)
+        lines += 1
+        report(job, lines)
+    if process.wait():
+        raise RuntimeError('Exited with status {}\n{}'.format(process.returncode, ''.join(output)))
+    return ''.join(output)
+
+
+# Handler for each job type, called with the job and its args
+handlers = {
+    'sync_distinct': sync_distinct,
+    'scrape_location': scrape_location,
+    'script': run_script,
+}
@@ -1,35 +1,326 @@
-from models import Beverage
+from collections import OrderedDict
+from itertools import groupby
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import func, or_
+from web import db
+from models import Beverage, BeverageScrape, Location, MenuScrape, MenuChange
+
+# Rows fetched at a time when streaming a location's menus
+STREAM_BATCH_SIZE = 1000
+
+
+def diff_range(location_id, start, end):
+    """
+    Return the difference in beverages at a location between two points in time from the menu change log.
+
+    Each beverage's changes after start up to and including end are summed, beverages with a net change were added or
+    removed. Only the change log index and the changed beverages are read.
+
+    :param location_id:
+    :type location_id: int
+    :param start: Time of the old menu.
+    :type start: datetime
+    :param end: Time of the new menu.
+    :type end: datetime
+    :return: List of added, removed Beverages
+    :rtype: Beverage[], Beverage[]
+    """
+    net = func.sum(MenuChange.change)
+    changed = db.session.query(MenuChange.beverage_id) \
+        .filter(MenuChange.location_id == location_id, MenuChange.created > start, MenuChange.created <= end) \
+        .group_by(MenuChange.beverage_id)
+    return _beverages(changed.having(net > 0)), _beverages(changed.having(net < 0))
+
+
+def changes_since(since, location_id=None):
+    """
+    Menu changes newer than a point in time, newest first. A feed of what's new since someone last looked.
+
+    :param since:
+    :type since: datetime
+    :param location_id: Only changes at this location, all locations by default
+    :type location_id: int
+    :return:
+    :rtype: MenuChange[]
+    """
+    query = MenuChange.query.filter(MenuChange.created > since)
+    if location_id:
+        query = query.filter(MenuChange.location_id == location_id)
+    return query.options(joinedload('beverage').joinedload('brewery'), joinedload('location')) \
+        .order_by(MenuChange.created.desc(), MenuChange.id).all()
+
+
+def previous_menu(menu_scrape):
+    """
+    Location's menu scraped before this one.
+
+    :param menu_scrape:
+    :type menu_scrape: MenuScrape
+    :return:
+    :rtype: MenuScrape|None
+    """
+    return MenuScrape.query.filter(MenuScrape.location_id == menu_scrape.location_id,
+                                   MenuScrape.created <= menu_scrape.created,
+                                   MenuScrape.id != menu_scrape.id) \
+        .order_by(MenuScrape.created.desc(), MenuScrape.id.desc()).first()
+
+
+def record_menu_changes(menu_scrape):
+    """
+    Add change log entries for a new menu compared with the location's previous menu to the session.
+
+    :param menu_scrape: New menu, must have been flushed
+    :type menu_scrape: MenuScrape
+    :return: Changes added
+    :rtype: MenuChange[]
+    """
+    previous = previous_menu(menu_scrape)
+    previous_ids = set(x for x, in _beverage_ids(previous)) if previous else set()
+    beverage_ids = set(x for x, in _beverage_ids(menu_scrape))
+    changes = [MenuChange(change=MenuChange.ADDED, created=menu_scrape.created, location_id=menu_scrape.location_id,
+                          beverage_id=x, menu_scrape_id=menu_scrape.id) for x in sorted(beverage_ids - previous_ids)]
+    changes += [MenuChange(change=MenuChange.REMOVED, created=menu_scrape.created,
+                           location_id=menu_scrape.location_id, beverage_id=x, menu_scrape_id=menu_scrape.id)
+                for x in sorted(previous_ids - beverage_ids)]
+    db.session.add_all(changes)
+    return changes
+
+
+def log_location_changes(location_id, after=None):
+    """
+    Write change log entries for a location's menus scraped after a point in time, in a single pass over the menus in
+    the order they were scraped.
+
+    :param location_id:
+    :type location_id: int
+    :param after: Time of the last menu already in the log, all menus are logged by default
+    :type after: datetime
+    :return: Number of menus and changes logged
+    :rtype: (int, int)
+    """
+    previous_ids = set()
+    if after:
+        previous = MenuScrape.query.filter(MenuScrape.location_id == location_id, MenuScrape.created <= after) \
+            .order_by(MenuScrape.created.desc(), MenuScrape.id.desc()).first()
+        if previous:
+            previous_ids = set(x for x, in _beverage_ids(previous))
+    menus = 0
+    changes = []
+    for menu_id, created, beverage_ids in iter_menus(location_id, after):
+        changes += [(MenuChange.ADDED, created, menu_id, x) for x in sorted(beverage_ids - previous_ids)]
+        changes += [(MenuChange.REMOVED, created, menu_id, x) for x in sorted(previous_ids - beverage_ids)]
+        previous_ids = beverage_ids
+        menus += 1
+    if changes:
+        db.session.execute(MenuChange.__table__.insert(), [
+            {'change': change, 'created': created, 'location_id': location_id, 'menu_scrape_id': menu_id,
+             'beverage_id': beverage_id}
+            for change, created, menu_id, beverage_id in changes
+        ])
+    return menus, len(changes)
+
+
+class Tenure(object):
+    """
+    Time a beverage spent on a location's menu.
+    """
+
+    def __init__(self, beverage_id, first_seen, last_seen=None, days=0):
+        self.beverage_id = beverage_id
+        self.first_seen = first_seen
+        self.last_seen = last_seen or first_seen
+        # Days between each time the beverage was added and removed, or the end of the timeline if it was never removed
+        self.days = days
+        # When the beverage was last added, None if it is off the menu
+        self.since = first_seen
+
+    def __repr__(self):
+        return '<Tenure {} {} days>'.format(self.beverage_id, self.days)
+
+    def flatten(self):
+        return {
+            'beverage_id': self.beverage_id,
+            'first_seen': self.first_seen.isoformat(),
+            'last_seen': self.last_seen.isoformat(),
+            'days': self.days
+        }
+
+
+def menu_timeline(location_id, start=None, end=None):
+    """
+    Every beverage added to and removed from a location's menu over a date range, along with how long each beverage
+    was on the menu.
+
+    Built in a single pass over the location's menus in the order they were scraped. The menu in effect at start, the
+    last one scraped at or before it, is the starting point and its beverages are not reported as added. Without one
+    the first menu in the range is the starting point.
+
+    Unchanged menus are not scraped again, so the last menu is known to still be current when the location's menu was
+    last checked. Beverages still on it stay on tap up to then, or up to end if that's earlier.
+
+    :param location_id:
+    :type location_id: int
+    :param start: Start of the range
+    :type start: datetime
+    :param end: Only menus scraped up to and including this time
+    :type end: datetime
+    :return: Changes of each menu in order as time scraped, menu ID, added and removed beverage IDs. Tenure of every
+    beverage seen, ordered by when it was first seen.
+    :rtype: ((datetime, int, int[], int[])[], Tenure[])
+    """
+    changes = []
+    tenures = OrderedDict()
+    previous_ids = None
+    created = None
+    baseline = menu_at(location_id, start) if start else None
+    if baseline:
+        previous_ids = set(x for x, in _beverage_ids(baseline))
+        created = start
+        for beverage_id in sorted(previous_ids):
+            tenures[beverage_id] = Tenure(beverage_id, start)
+    for menu_id, created, beverage_ids in iter_menus(location_id, after=start if baseline else None, end=end,
+                                                     start=start):
+        added = beverage_ids if previous_ids is None else beverage_ids - previous_ids
+        removed = previous_ids - beverage_ids if previous_ids else set()
+        for beverage_id in added:
+            tenure = tenures.get(beverage_id)
+            if tenure:
+                tenure.since = created
+            else:
+                tenures[beverage_id] = Tenure(beverage_id, created)
+        for beverage_id in beverage_ids:
+            tenures[beverage_id].last_seen = created
+        for beverage_id in removed:
+            tenure = tenures[beverage_id]
+            tenure.days += _days(created - tenure.since)
+            tenure.since = None
+        if previous_ids is not None and (added or removed):
+            changes.append((created, menu_id, sorted(added), sorted(removed)))
+        previous_ids = beverage_ids
+    # Beverages still on the last menu
+    if created:
+        checked = db.session.query(Location.menu_checked).filter(Location.id == location_id).scalar()
+        closed = max(created, checked) if checked else created
+        if end:
+            closed = max(created, min(closed, end))
+    for tenure in tenures.itervalues():
+        if tenure.since:
+            tenure.days += _days(closed - tenure.since)
+            tenure.last_seen = closed
+            tenure.since = None
+    return changes, tenures.values()
+
+
+def menu_at(location_id, time):
+    """
+    Location's menu in effect at a point in time, the last one scraped at or before it.
+
+    :param location_id:
+    :type location_id: int
+    :param time:
+    :type time: datetime
+    :return:
+    :rtype: MenuScrape|None
+    """
+    return MenuScrape.query.filter(MenuScrape.location_id == location_id, MenuScrape.created <= time) \
+        .order_by(MenuScrape.created.desc(), MenuScrape.id.desc()).first()
+
+
+def nearest_menu(location_id, time):
+    """
+    Location's menu in effect at a point in time, or its first menu if it was scraped after.
+
+    :param location_id:
+    :type location_id: int
+    :param time:
+    :type time: datetime
+    :return:
+    :rtype: MenuScrape|None
+    """
+    return menu_at(location_id, time) or MenuScrape.query.filter(
+        MenuScrape.location_id == location_id, MenuScrape.created > time) \
+        .order_by(MenuScrape.created, MenuScrape.id).first()
+
+
+def timeline_beverages(location_id, start=None, end=None):
+    """
+    Every beverage on a location's menus over a date range, for showing a menu_timeline.
+
+    :param location_id:
+    :type location_id: int
+    :param start: Only menus scraped at or after this time and the menu in effect at it
+    :type start: datetime
+    :param end: Only menus scraped up to and including this time
+    :type end: datetime
+    :return: Beverages keyed by ID
+    :rtype: dict
+    """
+    ids = db.session.query(BeverageScrape.beverage_id).join(MenuScrape) \
+        .filter(MenuScrape.location_id == location_id)
+    if start:
+        baseline = menu_at(location_id, start)
+        ids = ids.filter(or_(MenuScrape.created >= start, MenuScrape.id == (baseline.id if baseline else None)))
+    if end:
+        ids = ids.filter(MenuScrape.created <= end)
+    return dict((x.id, x) for x in _beverages(ids.distinct()))
+
+
+def _days(delta):
+    return round(delta.total_seconds() / 86400, 1)
+
+
+def iter_menus(location_id, after=None, end=None, start=None):
+    """
+    Beverages on each of a location's menus in the order they were scraped, streamed from a single query.
+
+    :param location_id:
+    :type location_id: int
+    :param after: Only menus scraped after this time
+    :type after: datetime
+    :param end: Only menus scraped up to and including this time
+    :type end: datetime
+    :param start: Only menus scraped at or after this time
+    :type start: datetime
+    :return: Generator of menu ID, time scraped and beverage IDs
+    :rtype: (int, datetime, set)[]
+    """
+    query = db.session.query(MenuScrape.id, MenuScrape.created, BeverageScrape.beverage_id) \
+        .outerjoin(BeverageScrape, BeverageScrape.menu_scrape_id == MenuScrape.id) \
+        .filter(MenuScrape.location_id == location_id)
+    if after:
+        query = query.filter(MenuScrape.created > after)
+    if start:
+        query = query.filter(MenuScrape.created >= start)
+    if end:
+        query = query.filter(MenuScrape.created <= end)
+    rows = query.order_by(MenuScrape.created, MenuScrape.id).yield_per(STREAM_BATCH_SIZE)
+    for (menu_id, created), menu_rows in groupby(rows, lambda x: (x[0], x[1])):
+        yield menu_id, created, set(x[2] for x in menu_rows if x[2] is not None)
+
+
+def _beverage_ids(menu):
+    return db.session.query(BeverageScrape.beverage_id).filter(BeverageScrape.menu_scrape_id == menu.id)
+
+
+def _beverages(ids):
+    return Beverage.query.filter(Beverage.id.in_(ids)).options(joinedload('brewery')).order_by(Beverage.name).all()
 
 
 def diff_beverages(old_beverages, new_beverages):
     """
     Return the difference in beverages between an old list and a new list.
 
+    Beverages are matched on name and brewery.
+
     :param old_beverages: Old beverage list.
-    :type old_beverages: Beverage[]
+    :type old_beverages: Beverage[]|ScrapedBeverage[]
     :param new_beverages: New beverage list.
-    :type new_beverages: Beverage[]
+    :type new_beverages: Beverage[]|ScrapedBeverage[]
     :return: List of added, removed Beverages
     :rtype: Beverage[], Beverage[]
     """
-    added = []
-    removed = []
-    for old_beverage in old_beverages:
-        found = False
-        for new_beverage in new_beverages:
-            if new_beverage.name == old_beverage.name and new_beverage.brewery == old_beverage.brewery:
-                found = True
-                break
-        if not found:
-            # Old beverage was removed
-            removed.append(old_beverage)
-    for new_beverage in new_beverages:
-        found = False
-        for old_beverage in old_beverages:
-            if old_beverage.name == new_beverage.name and old_beverage.brewery == new_beverage.brewery:
-                found = True
-                break
-        if not found:
-            # New beverage was added
-            added.append(new_beverage)
+    old_keys = set((x.name, x.brewery) for x in old_beverages)
+    new_keys = set((x.name, x.brewery) for x in new_beverages)
+    added = [x for x in new_beverages if (x.name, x.brewery) not in old_keys]
+    removed = [x for x in old_beverages if (x.name, x.brewery) not in new_keys]
     return added, removed
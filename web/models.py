@@ -3,21 +3,29 @@ from datetime import datetime
 
 
 class MenuScrape(db.Model):
+    __table_args__ = (
+        # Menus of a location by date
+        db.Index('ix_menu_scrape_location_id_created', 'location_id', 'created'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     url = db.Column(db.String(128))
     created = db.Column(db.DateTime)
+    # Digest of the raw HTML in the snapshot store
+    html_digest = db.Column(db.String(40))
 
     beverage_scrapes = db.relationship('BeverageScrape', backref='menu_scrape')
 
     location_id = db.Column(db.Integer, db.ForeignKey('location.id'))
 
-    def __init__(self, location=None, url=None, beverages=None, created=None):
+    def __init__(self, location=None, url=None, beverages=None, created=None, html_digest=None):
         if location:
             self.location = location
         self.url = url
         if beverages:
             self.beverages = beverages
         self.created = created or datetime.now()
+        self.html_digest = html_digest
 
     def __repr__(self):
         return '<MenuScrape {}-{}>'.format(self.location_id, self.created)
@@ -27,7 +35,8 @@ class MenuScrape(db.Model):
             'id': self.id,
             'url': self.url,
             'created': self.created.isoformat(),
-            'location_id': self.location_id
+            'location_id': self.location_id,
+            'html_digest': self.html_digest
         }
 
 
@@ -40,7 +49,7 @@ class BeverageScrape(db.Model):
 
     location_id = db.Column(db.Integer, db.ForeignKey('location.id'))
 
-    menu_scrape_id = db.Column(db.Integer, db.ForeignKey('menu_scrape.id'))
+    menu_scrape_id = db.Column(db.Integer, db.ForeignKey('menu_scrape.id'), index=True)
 
     def __init__(self, beverage=None, location=None, menu_scrape=None, scraped_value=None, created=None):
         if beverage:
@@ -66,7 +75,84 @@ class BeverageScrape(db.Model):
         }
 
 
+class MenuChange(db.Model):
+    """
+    Beverage added to or removed from a location's menu compared with the location's previous MenuScrape. Written when
+    a menu is scraped and never updated, see menu_diff.
+    """
+    __table_args__ = (
+        # Changes at a location over a date range
+        db.Index('ix_menu_change_location_id_created', 'location_id', 'created'),
+    )
+
+    ADDED = 1
+    REMOVED = -1
+
+    id = db.Column(db.Integer, primary_key=True)
+    # ADDED or REMOVED, summing a beverage's changes over a date range gives its net change
+    change = db.Column(db.Integer)
+    # Same as the MenuScrape
+    created = db.Column(db.DateTime)
+
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'))
+    beverage_id = db.Column(db.Integer, db.ForeignKey('beverage.id'))
+    menu_scrape_id = db.Column(db.Integer, db.ForeignKey('menu_scrape.id'))
+
+    beverage = db.relationship('Beverage')
+    location = db.relationship('Location')
+
+    def __init__(self, change=None, created=None, location_id=None, beverage_id=None, menu_scrape_id=None):
+        self.change = change
+        self.created = created or datetime.now()
+        self.location_id = location_id
+        self.beverage_id = beverage_id
+        self.menu_scrape_id = menu_scrape_id
+
+    def __repr__(self):
+        return '<MenuChange {}{}>'.format('+' if self.change == self.ADDED else '-', self.beverage_id)
+
+    def flatten(self):
+        return {
+            'id': self.id,
+            'change': self.change,
+            'created': self.created.isoformat(),
+            'location_id': self.location_id,
+            'beverage_id': self.beverage_id,
+            'menu_scrape_id': self.menu_scrape_id
+        }
+
+
+class ParsedValue(db.Model):
+    """
+    Persisted BeerParser result for a scraped value, see stout.CachedBeerParser.
+    """
+    __table_args__ = (
+        # One result per parser version and value, results are loaded by parser version
+        db.Index('ix_parsed_value_parser_scraped_value', 'parser', 'scraped_value', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    parser = db.Column(db.String(255))
+    scraped_value = db.Column(db.String(128))
+    data = db.Column(db.Text)
+    created = db.Column(db.DateTime)
+
+    def __init__(self, parser=None, scraped_value=None, data=None, created=None):
+        self.parser = parser
+        self.scraped_value = scraped_value
+        self.data = data
+        self.created = created or datetime.now()
+
+    def __repr__(self):
+        return '<ParsedValue {}>'.format(self.scraped_value)
+
+
 class Beverage(db.Model):
+    __table_args__ = (
+        # Beverages are matched to scrapes by name and brewery, unique so a scrape can only match one
+        db.Index('ix_beverage_name_brewery_id', 'name', 'brewery_id', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128))
     type = db.Column(db.String(32))
@@ -78,7 +164,7 @@ class Beverage(db.Model):
     price = db.Column(db.Numeric(5, 2))
     volume = db.Column(db.Numeric(5, 2))
     volume_units = db.Column(db.String(32))
-    untappd_id = db.Column(db.String(128))
+    untappd_id = db.Column(db.String(128), index=True)
     created = db.Column(db.DateTime)
     is_active = db.Column(db.Boolean)
 
@@ -135,6 +221,11 @@ class Beverage(db.Model):
 
 
 class Brewery(db.Model):
+    __table_args__ = (
+        # Unique index rather than a constraint so it can be added to an existing SQLite table
+        db.Index('ix_brewery_name', 'name', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128))
     location = db.Column(db.String(128))
@@ -165,6 +256,12 @@ class Location(db.Model):
     url = db.Column(db.String(128))
     untappd_id = db.Column(db.String(128))
     created = db.Column(db.DateTime)
+    # HTTP validators and digest of the last menu downloaded, used to skip unchanged menus
+    menu_etag = db.Column(db.String(128))
+    menu_last_modified = db.Column(db.String(64))
+    menu_digest = db.Column(db.String(40))
+    # Last time the menu was checked, it has been unchanged since the newest MenuScrape
+    menu_checked = db.Column(db.DateTime)
 
     chain_id = db.Column(db.Integer, db.ForeignKey('chain.id'))
 
@@ -190,7 +287,8 @@ class Location(db.Model):
             'name': self.name,
             'url': self.url,
             'untappd_id': self.untappd_id,
-            'created': self.created.isoformat()
+            'created': self.created.isoformat(),
+            'menu_checked': self.menu_checked.isoformat() if self.menu_checked else None
         }
 
 
@@ -221,6 +319,9 @@ class User(db.Model):
     username = db.Column(db.String(128))
     access_token = db.Column(db.String(40))
     created = db.Column(db.DateTime)
+    # Newest check-in stored by the last distinct beer sync and when that sync finished
+    distinct_checkin_id = db.Column(db.Integer)
+    distinct_synced_at = db.Column(db.DateTime)
 
     distinct_beers = db.relationship('DistinctBeer', backref='user')
 
@@ -241,8 +342,13 @@ class User(db.Model):
 
 
 class DistinctBeer(db.Model):
+    __table_args__ = (
+        # One row per beer a user has checked in
+        db.Index('ix_distinct_beer_user_id_untappd_bid', 'user_id', 'untappd_bid', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    untappd_bid = db.Column(db.Integer)
+    untappd_bid = db.Column(db.Integer, index=True)
     untappd_username = db.Column(db.String(128))
 
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -255,3 +361,70 @@ class DistinctBeer(db.Model):
             self.user = user
         if beverage:
             self.beverage = beverage
+
+
+class Job(db.Model):
+    """
+    Work queued by the web app and run by scripts.job_worker, see jobs.
+    """
+    __table_args__ = (
+        # Next job to claim
+        db.Index('ix_job_state_id', 'state', 'id'),
+        # Identical jobs waiting or running
+        db.Index('ix_job_key_state', 'key', 'state'),
+    )
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    id = db.Column(db.Integer, primary_key=True)
+    type = db.Column(db.String(32))
+    # JSON keyword arguments of the job's handler
+    args = db.Column(db.Text)
+    # Digest of the type and args, identical jobs have the same key
+    key = db.Column(db.String(40))
+    state = db.Column(db.String(16))
+    # Work done out of total, total is None until the job knows it
+    progress = db.Column(db.Integer)
+    total = db.Column(db.Integer)
+    # Summary of what a finished job did, or why it failed
+    result = db.Column(db.Text)
+    worker = db.Column(db.String(128))
+    # Number of times the job was claimed, claims compare and set it. A claimed job's attempt holds the value of its
+    # own claim, see jobs.owned.
+    attempts = db.Column(db.Integer)
+    created = db.Column(db.DateTime)
+    started = db.Column(db.DateTime)
+    # Last sign of life from the worker running the job
+    updated = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+
+    def __init__(self, type=None, args=None, key=None, state=PENDING, created=None):
+        self.type = type
+        self.args = args
+        self.key = key
+        self.state = state
+        self.progress = 0
+        self.attempts = 0
+        self.created = created or datetime.now()
+        self.updated = self.created
+
+    def __repr__(self):
+        return '<Job {} {} {}>'.format(self.id, self.type, self.state)
+
+    def flatten(self):
+        return {
+            'id': self.id,
+            'type': self.type,
+            'state': self.state,
+            'progress': self.progress,
+            'total': self.total,
+            'result': self.result,
+            'attempts': self.attempts,
+            'created': self.created.isoformat(),
+            'started': self.started.isoformat() if self.started else None,
+            'updated': self.updated.isoformat() if self.updated else None,
+            'finished': self.finished.isoformat() if self.finished else None
+        }
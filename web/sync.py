@@ -0,0 +1,116 @@
+from datetime import datetime
+from sqlalchemy.sql import func, bindparam
+from web import db
+from models import Beverage, DistinctBeer
+from consumption import consumed_cache
+
+# Beers requested per page of a user's history, the most Untappd returns at once
+SYNC_PAGE_SIZE = 50
+
+
+def sync_distinct_beers(user, untappd, progress=None):
+    """
+    Store the beers a user has checked in since their last sync.
+
+    The user's beers are paged most recently checked in first. Paging stops at the first beer whose latest check-in
+    is no newer than the high-water mark, the newest check-in stored by the previous sync, so a re-sync only reads the
+    pages with new check-ins. Each page is stored with a fixed number of queries and committed on its own. The mark
+    only moves once every page is stored, an interrupted sync starts over from the old mark.
+
+    :param user:
+    :type user: User
+    :param untappd: Client authenticated as the user
+    :type untappd: untappd.Untappd
+    :param progress: Called with the number of beers read and the user's total after each page
+    :type progress: callable
+    :return: Number of distinct beers added
+    :rtype: int
+    """
+    mark = user.distinct_checkin_id or 0
+    newest = mark
+    offset = 0
+    added = 0
+    while True:
+        response = untappd.user.beers(user.username, {'offset': offset, 'limit': SYNC_PAGE_SIZE, 'sort': 'date'})
+        if not response or not response['beers']['items']:
+            break
+        items = response['beers']['items']
+        offset += response['beers']['count']
+        new_items = [x for x in items if x['recent_checkin_id'] > mark]
+        newest = max([newest] + [x['recent_checkin_id'] for x in new_items])
+        added += store_distinct_beers(user, [x['beer']['bid'] for x in new_items])
+        db.session.commit()
+        if progress:
+            progress(offset, response['beers'].get('total_count'))
+        if len(new_items) < len(items):
+            # Reached beers synced before, the rest of the history is older
+            break
+    user.distinct_checkin_id = newest
+    user.distinct_synced_at = datetime.now()
+    db.session.commit()
+    consumed_cache.invalidate(user.id)
+    return added
+
+
+def store_distinct_beers(user, bids):
+    """
+    Insert the distinct beers a user doesn't have yet, linked to the beverage with the same Untappd ID.
+
+    One query finds the beers already stored, one finds the beverages and one inserts the rest.
+
+    :param user:
+    :type user: User
+    :param bids: Untappd beer IDs
+    :type bids: int[]
+    :return: Number of distinct beers inserted
+    :rtype: int
+    """
+    bids = set(bids)
+    if not bids:
+        return 0
+    stored = db.session.query(DistinctBeer.untappd_bid).filter(DistinctBeer.user_id == user.id,
+                                                                DistinctBeer.untappd_bid.in_(bids))
+    bids = sorted(bids - set(x for x, in stored))
+    if not bids:
+        return 0
+    # Oldest beverage for each Untappd ID, untappd_id is a string column
+    beverages = dict(db.session.query(Beverage.untappd_id, func.min(Beverage.id)).filter(
+        Beverage.untappd_id.in_([str(x) for x in bids])).group_by(Beverage.untappd_id))
+    db.session.execute(DistinctBeer.__table__.insert(), [{
+        'untappd_bid': bid,
+        'untappd_username': user.username,
+        'user_id': user.id,
+        'beverage_id': beverages.get(str(bid)),
+    } for bid in bids])
+    return len(bids)
+
+
+def assign_untappd_ids(pairs):
+    """
+    Set the Untappd ID of many beverages at once and link every distinct beer with those IDs to their beverage.
+
+    One query finds the beverages that exist, then one statement updates the beverages and one the distinct beers, each
+    executed with all the pairs. Nothing is committed.
+
+    :param pairs: Beverage ID and Untappd beer ID pairs, the last pair wins for a beverage given twice
+    :type pairs: (int, int)[]
+    :return: Number of beverages updated
+    :rtype: int
+    """
+    bids = dict(pairs)
+    if not bids:
+        return 0
+    existing = db.session.query(Beverage.id).filter(Beverage.id.in_(bids.keys()))
+    bids = dict((x, bids[x]) for x, in existing)
+    if not bids:
+        return 0
+    # Bound names can't be the same as the columns they set
+    beverage = Beverage.__table__
+    db.session.execute(beverage.update().where(beverage.c.id == bindparam('b_id')).values(
+        untappd_id=bindparam('b_untappd_id')),
+        [{'b_id': beverage_id, 'b_untappd_id': str(bid)} for beverage_id, bid in bids.iteritems()])
+    distinct_beer = DistinctBeer.__table__
+    db.session.execute(distinct_beer.update().where(distinct_beer.c.untappd_bid == bindparam('b_bid')).values(
+        beverage_id=bindparam('b_beverage_id')),
+        [{'b_beverage_id': beverage_id, 'b_bid': bid} for beverage_id, bid in bids.iteritems()])
+    return len(bids)
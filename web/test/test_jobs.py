@@ -0,0 +1,107 @@
+import time
+from datetime import datetime, timedelta
+from web import db
+from web.models import Job
+from web import jobs
+from web.testing import DatabaseTestCase
+import logging
+
+root_log = logging.getLogger()
+root_log.setLevel(logging.WARN)
+root_log.addHandler(logging.NullHandler())
+
+
+class TestRun(DatabaseTestCase):
+    def setUp(self):
+        super(TestRun, self).setUp()
+        self.calls = []
+        jobs.handlers['test'] = self.handler
+        self.job = Job('test', '{}', 'test')
+        self.job.state = Job.RUNNING
+        self.job.attempts = 1
+        self.job.updated = datetime.now() - timedelta(minutes=10)
+        db.session.add(self.job)
+        db.session.commit()
+        self.job.attempt = 1
+
+    def tearDown(self):
+        del jobs.handlers['test']
+        super(TestRun, self).tearDown()
+
+    def handler(self, job):
+        self.calls.append(job.id)
+        return 'ran'
+
+    def test_run(self):
+        """ Test the result of a job is recorded """
+        self.assertTrue(jobs.run(self.job))
+        db.session.refresh(self.job)
+        self.assertEqual([self.job.id], self.calls)
+        self.assertEqual(Job.DONE, self.job.state)
+        self.assertEqual('ran', self.job.result)
+
+    def test_failure(self):
+        """ Test a job that raises is recorded as failed """
+        def fail(job):
+            raise ValueError('broken')
+        jobs.handlers['test'] = fail
+        self.assertTrue(jobs.run(self.job))
+        db.session.refresh(self.job)
+        self.assertEqual(Job.FAILED, self.job.state)
+        self.assertEqual('ValueError: broken', self.job.result)
+
+    def test_reclaimed(self):
+        """ Test the result of a job claimed again by another worker while it ran is discarded """
+        def reclaimed(job):
+            db.session.execute(Job.__table__.update().where(Job.id == job.id).values(attempts=2, worker='other'))
+            db.session.commit()
+            jobs.report(job, 5)
+            return 'stale'
+        jobs.handlers['test'] = reclaimed
+        self.assertFalse(jobs.run(self.job))
+        db.session.refresh(self.job)
+        self.assertEqual(Job.RUNNING, self.job.state)
+        self.assertEqual('other', self.job.worker)
+        self.assertIsNone(self.job.result)
+        self.assertEqual(0, self.job.progress)
+
+    def test_final_progress(self):
+        """ Test progress reported too soon after the previous report is still recorded """
+        def steps(job, total=None):
+            for i in range(1, 121):
+                jobs.report(job, i, total)
+        jobs.handlers['test'] = lambda job: steps(job, 120)
+        self.assertTrue(jobs.run(self.job))
+        db.session.refresh(self.job)
+        self.assertEqual((120, 120), (self.job.progress, self.job.total))
+        # Without a total
+        self.job.state = Job.RUNNING
+        self.job.progress = 0
+        self.job.total = None
+        db.session.commit()
+        self.job.unreported = None
+        jobs.handlers['test'] = steps
+        self.assertTrue(jobs.run(self.job))
+        db.session.refresh(self.job)
+        self.assertEqual((120, None), (self.job.progress, self.job.total))
+
+    def test_heartbeat(self):
+        """ Test a job that doesn't report progress is kept alive by the heartbeat """
+        heartbeat = jobs.Heartbeat(self.job, 0.05)
+        heartbeat.start()
+        time.sleep(0.3)
+        heartbeat.stop()
+        db.session.refresh(self.job)
+        self.assertGreater(self.job.updated, datetime.now() - timedelta(seconds=1))
+
+    def test_heartbeat_reclaimed(self):
+        """ Test the heartbeat of a job claimed again by another worker stops marking it alive """
+        updated = self.job.updated
+        db.session.execute(Job.__table__.update().where(Job.id == self.job.id).values(attempts=2))
+        db.session.commit()
+        heartbeat = jobs.Heartbeat(self.job, 0.05)
+        heartbeat.start()
+        time.sleep(0.3)
+        heartbeat.stop()
+        db.session.refresh(self.job)
+        self.assertEqual(updated, self.job.updated)
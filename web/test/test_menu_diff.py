@@ -0,0 +1,128 @@
+from datetime import datetime, timedelta
+from web import app, db
+from web.models import Location, Beverage, BeverageScrape, MenuScrape, MenuChange
+from web.menu_diff import menu_timeline, timeline_beverages, record_menu_changes, diff_range
+from web.testing import DatabaseTestCase
+import logging
+
+root_log = logging.getLogger()
+root_log.setLevel(logging.WARN)
+root_log.addHandler(logging.NullHandler())
+
+DAY = datetime(2014, 8, 1)
+
+
+class MenuTestCase(DatabaseTestCase):
+    """ Location with beverages a, b and c and no menus """
+
+    def setUp(self):
+        super(MenuTestCase, self).setUp()
+        self.location = Location(name='Test', url='http://localhost/menu')
+        db.session.add(self.location)
+        self.beverages = dict((x, Beverage(name=x, location=self.location)) for x in 'abc')
+        db.session.add_all(self.beverages.values())
+        db.session.commit()
+
+    def add_menu(self, days, names):
+        """ Menu scraped days after DAY with the named beverages, logged as it is at scrape time """
+        menu = MenuScrape(location=self.location, url=self.location.url, created=DAY + timedelta(days=days))
+        db.session.add(menu)
+        db.session.add_all(BeverageScrape(beverage=self.beverages[x], location=self.location, menu_scrape=menu,
+                                          scraped_value=x, created=menu.created) for x in names)
+        db.session.flush()
+        record_menu_changes(menu)
+        db.session.commit()
+        return menu
+
+    def id(self, name):
+        return self.beverages[name].id
+
+
+class TestMenuChanges(MenuTestCase):
+    def changes(self, menu):
+        return sorted((x.change, x.beverage_id) for x in MenuChange.query.filter_by(menu_scrape_id=menu.id))
+
+    def test_record_menu_changes(self):
+        """ Test each menu logs the beverages added and removed since the previous one """
+        first = self.add_menu(0, 'ab')
+        second = self.add_menu(10, 'ac')
+        third = self.add_menu(20, 'ac')
+        self.assertEqual([(MenuChange.ADDED, self.id('a')), (MenuChange.ADDED, self.id('b'))], self.changes(first))
+        self.assertEqual(sorted([(MenuChange.ADDED, self.id('c')), (MenuChange.REMOVED, self.id('b'))]),
+                         self.changes(second))
+        self.assertEqual([], self.changes(third))
+
+    def test_diff_range(self):
+        """ Test a date range is diffed from the log whether or not a menu was scraped on either day """
+        self.add_menu(0, 'ab')
+        self.add_menu(10, 'ac')
+        self.add_menu(20, 'a')
+        added, removed = diff_range(self.location.id, DAY + timedelta(days=3), DAY + timedelta(days=15))
+        self.assertEqual([self.id('c')], [x.id for x in added])
+        self.assertEqual([self.id('b')], [x.id for x in removed])
+        added, removed = diff_range(self.location.id, DAY + timedelta(days=3), DAY + timedelta(days=25))
+        self.assertEqual([], added)
+        self.assertEqual([self.id('b')], [x.id for x in removed])
+
+    def test_diff_view(self):
+        """ Test the diff page works for days without a menu of their own """
+        self.add_menu(0, 'ab')
+        self.add_menu(10, 'ac')
+        response = app.test_client().get('/menus/diff?location_id={}&start=2014-08-04&end=2014-08-15'.format(
+            self.location.id))
+        self.assertEqual(200, response.status_code)
+        self.assertIn('<h2>Added</h2>', response.data)
+        self.assertIn('<h2>Removed</h2>', response.data)
+        self.assertIn('2014-08-01', response.data)
+        self.assertIn('2014-08-11', response.data)
+
+
+class TestMenuTimeline(MenuTestCase):
+    def setUp(self):
+        super(TestMenuTimeline, self).setUp()
+        self.first = self.add_menu(0, 'ab')
+        self.second = self.add_menu(10, 'ac')
+        # Unchanged menus since the second one aren't scraped
+        self.location.menu_checked = DAY + timedelta(days=20)
+        db.session.commit()
+
+    def tenures(self, start=None, end=None):
+        changes, tenures = menu_timeline(self.location.id, start, end)
+        return changes, dict((x.beverage_id, x) for x in tenures)
+
+    def test_whole_history(self):
+        """ Test the first menu is the starting point and open tenures run until the menu was last checked """
+        changes, tenures = self.tenures()
+        self.assertEqual([(self.second.created, self.second.id, [self.id('c')], [self.id('b')])], changes)
+        self.assertEqual(20, tenures[self.id('a')].days)
+        self.assertEqual(10, tenures[self.id('b')].days)
+        self.assertEqual(10, tenures[self.id('c')].days)
+        self.assertEqual(DAY + timedelta(days=20), tenures[self.id('a')].last_seen)
+        self.assertEqual(self.first.created, tenures[self.id('b')].last_seen)
+
+    def test_menu_in_effect_at_start(self):
+        """ Test the menu scraped before start is the starting point """
+        start = DAY + timedelta(days=5)
+        changes, tenures = self.tenures(start)
+        self.assertEqual([(self.second.created, self.second.id, [self.id('c')], [self.id('b')])], changes)
+        self.assertEqual(start, tenures[self.id('a')].first_seen)
+        self.assertEqual(15, tenures[self.id('a')].days)
+        self.assertEqual(5, tenures[self.id('b')].days)
+        self.assertEqual(10, tenures[self.id('c')].days)
+        self.assertIn(self.id('b'), timeline_beverages(self.location.id, start))
+
+    def test_end(self):
+        """ Test open tenures stop at end when it's before the menu was last checked """
+        end = DAY + timedelta(days=15)
+        changes, tenures = self.tenures(DAY + timedelta(days=5), end)
+        self.assertEqual(10, tenures[self.id('a')].days)
+        self.assertEqual(5, tenures[self.id('c')].days)
+        self.assertEqual(end, tenures[self.id('c')].last_seen)
+
+    def test_never_checked(self):
+        """ Test open tenures stop at the last menu without a check time """
+        self.location.menu_checked = None
+        db.session.commit()
+        changes, tenures = self.tenures()
+        self.assertEqual(10, tenures[self.id('a')].days)
+        self.assertEqual(0, tenures[self.id('c')].days)
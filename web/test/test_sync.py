@@ -0,0 +1,101 @@
+import unittest
+from web import db
+from web.models import Beverage, DistinctBeer, User
+from web.sync import sync_distinct_beers, store_distinct_beers, SYNC_PAGE_SIZE
+from web.testing import DatabaseTestCase
+import logging
+
+root_log = logging.getLogger()
+root_log.setLevel(logging.WARN)
+root_log.addHandler(logging.NullHandler())
+
+
+class FakeUntappd(object):
+    """
+    Pages a user's beers out of a history, most recently checked in first, like Untappd's user beers endpoint.
+    """
+
+    def __init__(self, history):
+        self.history = history
+        self.calls = 0
+        self.user = self
+
+    def beers(self, username, params):
+        self.calls += 1
+        items = self.history[params['offset']:params['offset'] + params['limit']]
+        return {'beers': {'count': len(items), 'items': items, 'total_count': len(self.history)}}
+
+
+def checkin(bid, checkin_id):
+    return {'beer': {'bid': bid}, 'recent_checkin_id': checkin_id}
+
+
+class TestSync(DatabaseTestCase):
+    def setUp(self):
+        super(TestSync, self).setUp()
+        self.user = User('tester', 'token')
+        self.beverages = [Beverage(name='Test', untappd_id='5'), Beverage(name='Test duplicate', untappd_id='5')]
+        db.session.add(self.user)
+        db.session.add_all(self.beverages)
+        db.session.commit()
+        self.user_id = self.user.id
+        self.beverage_ids = [x.id for x in self.beverages]
+        # Beers 1 to 120, the higher the beer the older its check-in
+        self.history = [checkin(bid, 1000 - bid) for bid in range(1, 121)]
+
+    def stored(self):
+        return sorted(x for x, in db.session.query(DistinctBeer.untappd_bid).filter(
+            DistinctBeer.user_id == self.user_id))
+
+    def test_first_sync(self):
+        """ Test that the first sync reads every page and stores every beer """
+        untappd = FakeUntappd(self.history)
+        progress = []
+        self.assertEqual(120, sync_distinct_beers(self.user, untappd, lambda *args: progress.append(args)))
+        self.assertEqual(range(1, 121), self.stored())
+        self.assertEqual([(SYNC_PAGE_SIZE, 120), (2 * SYNC_PAGE_SIZE, 120), (120, 120)], progress)
+        # The last page is followed by an empty one
+        self.assertEqual(4, untappd.calls)
+        self.assertEqual(999, self.user.distinct_checkin_id)
+        self.assertIsNotNone(self.user.distinct_synced_at)
+
+    def test_incremental_sync(self):
+        """ Test that a re-sync only reads the page with new check-ins and only stores new beers """
+        sync_distinct_beers(self.user, FakeUntappd(self.history))
+        # Two new beers and another check-in of beer 7
+        history = [checkin(200, 2002), checkin(7, 2001), checkin(201, 2000)] + \
+            [x for x in self.history if x['beer']['bid'] != 7]
+        untappd = FakeUntappd(history)
+        self.assertEqual(2, sync_distinct_beers(self.user, untappd))
+        self.assertEqual(1, untappd.calls)
+        self.assertEqual(range(1, 121) + [200, 201], self.stored())
+        self.assertEqual(2002, self.user.distinct_checkin_id)
+
+    def test_no_new_checkins(self):
+        """ Test that a re-sync without new check-ins reads one page and stores nothing """
+        sync_distinct_beers(self.user, FakeUntappd(self.history))
+        untappd = FakeUntappd(self.history)
+        self.assertEqual(0, sync_distinct_beers(self.user, untappd))
+        self.assertEqual(1, untappd.calls)
+        self.assertEqual(999, self.user.distinct_checkin_id)
+
+    def test_empty_history(self):
+        """ Test that a user without check-ins syncs nothing """
+        self.assertEqual(0, sync_distinct_beers(self.user, FakeUntappd([])))
+        self.assertEqual([], self.stored())
+        self.assertEqual(0, self.user.distinct_checkin_id)
+
+    def test_store_distinct_beers(self):
+        """ Test that only beers the user doesn't have are stored, linked to the oldest beverage with their ID """
+        self.assertEqual(2, store_distinct_beers(self.user, [5, 6, 5]))
+        self.assertEqual(1, store_distinct_beers(self.user, [5, 6, 8]))
+        self.assertEqual(0, store_distinct_beers(self.user, []))
+        db.session.commit()
+        self.assertEqual([5, 6, 8], self.stored())
+        linked = dict(db.session.query(DistinctBeer.untappd_bid, DistinctBeer.beverage_id).filter(
+            DistinctBeer.user_id == self.user_id))
+        self.assertEqual({5: self.beverage_ids[0], 6: None, 8: None}, linked)
+
+
+if __name__ == '__main__':
+    unittest.main()
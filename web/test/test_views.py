@@ -0,0 +1,31 @@
+import re
+from web import app, db
+from web.models import Beverage
+from web.testing import DatabaseTestCase
+import logging
+
+root_log = logging.getLogger()
+root_log.setLevel(logging.WARN)
+root_log.addHandler(logging.NullHandler())
+
+
+class TestBeverageIndex(DatabaseTestCase):
+    def setUp(self):
+        super(TestBeverageIndex, self).setUp()
+        self.client = app.test_client()
+        self.beverages = [Beverage(name='Test {}'.format(i), untappd_id=None) for i in range(3)]
+        db.session.add_all(self.beverages)
+        db.session.commit()
+        self.ids = [x.id for x in self.beverages]
+
+    def listed(self, query):
+        response = self.client.get('/beverages?' + query)
+        self.assertEqual(200, response.status_code)
+        return len(re.findall('name="bid\[\]"', response.data))
+
+    def test_limit(self):
+        """ Test a page lists at least one and at most MAX_BEVERAGE_PAGE_SIZE beverages """
+        after = self.ids[0] - 1
+        self.assertEqual(2, self.listed('after={}&limit=2'.format(after)))
+        self.assertEqual(1, self.listed('after={}&limit=0'.format(after)))
+        self.assertEqual(1, self.listed('after={}&limit=-1'.format(after)))
@@ -0,0 +1,28 @@
+""" Test helpers """
+import os
+import tempfile
+import unittest
+from web import app, db
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Runs each test against a new database of its own, a temporary SQLite file with every table created, so tests never
+    touch the app's database. A file rather than memory so connections other than the session's see the same data.
+    Subclasses overriding setUp or tearDown must call these.
+    """
+
+    def setUp(self):
+        db.session.remove()
+        self._database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+        handle, self.database_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + self.database_path
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+        app.config['SQLALCHEMY_DATABASE_URI'] = self._database_uri
+        os.remove(self.database_path)
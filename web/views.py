@@ -1,12 +1,48 @@
 from web import app, db
-from flask import render_template, request, make_response, abort, redirect, session, g, url_for
+from flask import render_template, request, make_response, abort, redirect, session, g, url_for, jsonify
 from datetime import datetime, timedelta
 import json
 import dateutil.parser
+from sqlalchemy.orm import joinedload
 from sqlalchemy.sql import expression
-from menu_diff import diff_beverages
-from models import Location, MenuScrape, Chain, User, Beverage, DistinctBeer
-from untappd import Untappd
+from menu_diff import diff_range, changes_since, menu_timeline, timeline_beverages, nearest_menu
+from consumption import split_consumed, consumed_bids, consumed_cache
+from jobs import enqueue
+from sync import assign_untappd_ids
+from models import Location, MenuScrape, Chain, User, Beverage, Job
+from untappd import Untappd, create_session, Scheduler, INTERACTIVE
+from untappd.cache import SQLiteCache
+
+# Connections to Untappd are kept alive and shared by every request, as are cached responses and the rate limit
+untappd_session = create_session()
+# Created on first use so importing the app doesn't create the cache file
+untappd_cache = None
+# Per process, syncs run by the job worker only give way to these requests through the remaining calls Untappd
+# reports, see Scheduler
+untappd_scheduler = Scheduler()
+
+# Beverages listed per page of the beverage index by default and at most
+BEVERAGE_PAGE_SIZE = 100
+MAX_BEVERAGE_PAGE_SIZE = 500
+
+
+def untappd_client(access_token=None, priority=INTERACTIVE):
+    """
+    Untappd client for the current request using the shared connection pool.
+
+    :param access_token: User's OAuth token
+    :type access_token: str
+    :param priority: BACKGROUND for bulk calls, which give way to pages waiting on Untappd
+    :type priority: int
+    :return:
+    :rtype: Untappd
+    """
+    global untappd_cache
+    if untappd_cache is None:
+        untappd_cache = SQLiteCache(app.config['UNTAPPD_CACHE'])
+    return Untappd(client_id=app.config['UNTAPPD_CLIENT_ID'], client_secret=app.config['UNTAPPD_CLIENT_SECRET'],
+                   redirect_uri=app.config['UNTAPPD_REDIRECT_URI'], access_token=access_token,
+                   session=untappd_session, cache=untappd_cache, scheduler=untappd_scheduler, priority=priority)
 
 
 @app.before_request
@@ -35,43 +71,59 @@ def location(id):
     # current_user = None
     # if 'username' in request.cookies:
     # current_user = User.query.filter_by(username=request.cookies.get('username')).first()
-    #TODO: Join to find consumed/unconsumed
-    consumed = []
-    unconsumed = location.beverages[:]
-    for loc_bev in location.beverages:
-        if loc_bev.untappd_id:
-            for user_bev in current_user.distinct_beers:
-                if str(user_bev.untappd_bid) == str(loc_bev.untappd_id):
-                    consumed.append(loc_bev)
-                    for con_bev in unconsumed:
-                        if con_bev.untappd_id == loc_bev.untappd_id:
-                            del con_bev
+    beverages = Beverage.query.filter_by(location_id=location.id).options(joinedload('brewery')).order_by(Beverage.id)
+    consumed, unconsumed = split_consumed(beverages, current_user)
 
     return render_template('location_view.html', location=location, current_user=current_user, consumed=consumed,
                            unconsumed=unconsumed)
 
 
+@app.route('/locations/<id>/scrape', methods=['POST'])
+def location_scrape(id):
+    location = Location.query.get_or_404(id)
+    job = enqueue('scrape_location', location_id=location.id)
+    return redirect(url_for('job', id=job.id))
+
+
+@app.route('/locations/<id>/timeline')
+def location_timeline(id):
+    location = Location.query.get_or_404(id)
+    start = request.args.get('start')
+    if start:
+        start = dateutil.parser.parse(start)
+    else:
+        start = datetime.now() - timedelta(days=30)
+    end = request.args.get('end')
+    until = None
+    if end:
+        end = dateutil.parser.parse(end)
+        # Include the whole end day
+        until = end + timedelta(days=1)
+    changes, tenures = menu_timeline(location.id, start, until)
+    return render_template('location_timeline.html', location=location, start=start, end=end, changes=changes,
+                           tenures=tenures, beverages=timeline_beverages(location.id, start, until))
+
+
 @app.route('/beverages', methods=['GET', 'POST'])
 def beverage_index():
-    bids = request.form.getlist('bid[]')
-    beverage_ids = request.form.getlist('beverage_id[]')
-    if bids:
-        cnt = 0
-        for bid in bids:
-            if bid:
-                # Assumes sequential data
-                beverage_id = beverage_ids[cnt]
-                beverage = Beverage.query.get(beverage_id)
-                if beverage:
-                    beverage.untappd_id = str(bid)
-                    db.session.add(beverage)
-                    distinct = DistinctBeer.query.filter_by(untappd_bid=bid).first()
-                    if distinct:
-                        distinct.beverage_id = beverage.id
-            cnt += 1
+    if request.method == 'POST':
+        pairs = []
+        # Assumes sequential data
+        for beverage_id, bid in zip(request.form.getlist('beverage_id[]'), request.form.getlist('bid[]')):
+            # Blank and mistyped IDs are left unmapped
+            if beverage_id.strip().isdigit() and bid.strip().isdigit():
+                pairs.append((int(beverage_id), int(bid)))
+        assign_untappd_ids(pairs)
         db.session.commit()
-    beverages = Beverage.query.filter_by(type='Beer')
-    return render_template('beverage_index.html', beverages=beverages)
+    # Keyset pagination, a page starts after the last beverage of the previous one
+    after = request.args.get('after', 0, type=int)
+    limit = max(1, min(request.args.get('limit', BEVERAGE_PAGE_SIZE, type=int), MAX_BEVERAGE_PAGE_SIZE))
+    beverages = Beverage.query.filter(Beverage.type == 'Beer', Beverage.id > after).options(
+        joinedload('brewery')).order_by(Beverage.id).limit(limit).all()
+    next_after = beverages[-1].id if len(beverages) == limit else None
+    consumed = consumed_cache.get(g.user) if g.user else ()
+    return render_template('beverage_index.html', beverages=beverages, consumed=consumed, after=after, limit=limit,
+                           next_after=next_after)
 
 
 @app.route('/menus/')
@@ -90,8 +142,8 @@ def menu_diff():
     # TODO: add nearest cache support back
     # TODO: JS datepicker widget
     # Grab parameters
-    chain_id = request.args.get('chain_id')
-    location_id = request.args.get('location_id')
+    chain_id = request.args.get('chain_id', type=int)
+    location_id = request.args.get('location_id', type=int)
     start = request.args.get('start')
     if start:
         start = dateutil.parser.parse(start)
@@ -99,26 +151,17 @@ def menu_diff():
     if end:
         end = dateutil.parser.parse(end)
     # Compute diff
-    if location and start:
-        context['diff'] = {'added': [], 'removed': []}
-        # TODO: match on day, not entire created timestamp
-        # TODO: always return a menu if possible (nearest matching date)
-        # TODO: lean newer
-        context['old_menu'] = MenuScrape.query.filter(
-            expression.between(MenuScrape.created, start, start + timedelta(days=1)),
-            MenuScrape.location_id == location_id
-        ).first_or_404()
-        # TODO: lean older
-        context['new_menu'] = MenuScrape.query.filter(
-            expression.between(MenuScrape.created, end, end + timedelta(days=1)),
-            MenuScrape.location_id == location_id
-        ).first_or_404()
-        # TODO: if no end provided, get newest
-        added, removed = diff_beverages(context['old_menu'].beverages, context['new_menu'].beverages)
+    if location_id and start and end:
+        # Changes over the whole end day, unchanged menus aren't scraped so most days have no menu of their own
+        until = end + timedelta(days=1)
+        added, removed = diff_range(location_id, start, until)
         context['diff'] = {
             'added': added,
             'removed': removed
         }
+        # Menus in effect at either end, for display
+        context['old_menu'] = nearest_menu(location_id, start)
+        context['new_menu'] = nearest_menu(location_id, until)
     else:
         # Form defaults
         if not end:
@@ -146,11 +189,21 @@ def menu_diff():
     return render_template('menu_diff.html', **context)
 
 
+@app.route('/menus/changes')
+def menu_changes():
+    location_id = request.args.get('location_id', type=int)
+    since = request.args.get('since')
+    if since:
+        since = dateutil.parser.parse(since)
+    else:
+        since = datetime.now() - timedelta(days=7)
+    return render_template('menu_changes.html', changes=changes_since(since, location_id), since=since,
+                           location_id=location_id)
+
+
 @app.route('/auth')
 def untappd_auth():
-    untappd = Untappd(client_id='04513C89D24C72DD55C71441835D7BF4FF70077E',
-                      client_secret='02D05C33B6152E3BC9183ECB5BE58DF289D47457',
-                      redirect_uri='http://127.0.0.1:5000/auth')
+    untappd = untappd_client()
     if 'code' in request.args:
         access_token = untappd.oauth.get_token(request.args.get('code'))
         untappd.set_access_token(access_token)
@@ -170,28 +223,16 @@ def untappd_auth():
 @app.route('/sync_distinct')
 def sync_distinct():
     if g.user:
-        untappd = Untappd(client_id='04513C89D24C72DD55C71441835D7BF4FF70077E',
-                          client_secret='02D05C33B6152E3BC9183ECB5BE58DF289D47457',
-                          redirect_uri='http://dmertl.com/drink_different/auth')
-        untappd.set_access_token(g.user.access_token)
-        next_offset = 0
-        while True:
-            beers = untappd.user.beers(g.user.username, {'offset': next_offset, 'sort': 'date'})
-            if not beers or not beers['beers']['items']:
-                break
-            next_offset += beers['beers']['count']
-            for beer in beers['beers']['items']:
-                beverage = Beverage.query.filter_by(untappd_id=beer['beer']['bid']).first()
-                if not beverage:
-                    beverage = None
-                distinct_beer = DistinctBeer(untappd_bid=beer['beer']['bid'], untappd_username=g.user.username,
-                                             user=g.user, beverage=beverage)
-                db.session.add(distinct_beer)
-            db.session.commit()
-        return 'Done!'
+        # Run by scripts.job_worker, large histories take minutes
+        job = enqueue('sync_distinct', user_id=g.user.id)
+        return redirect(url_for('job', id=job.id))
     else:
         return abort(401)
 
+@app.route('/jobs/<int:id>')
+def job(id):
+    return jsonify(Job.query.get_or_404(id).flatten())
+
 @app.route('/live_beers')
 def live_beers_index():
     return render_template('live_beers/index.html')
@@ -199,19 +240,20 @@ def live_beers_index():
 @app.route('/live_beers/<id>')
 def live_beers_view(id):
     if g.user:
-        untappd = Untappd(client_id='04513C89D24C72DD55C71441835D7BF4FF70077E',
-                          client_secret='02D05C33B6152E3BC9183ECB5BE58DF289D47457',
-                          redirect_uri='http://dmertl.com/drink_different/auth')
+        untappd = untappd_client(g.user.access_token)
         response = untappd.venue.checkins(id)
-        beers = []
+        unique = []
+        bids = set()
         for item in response['checkins']['items']:
             # Ignore duplicate beers
-            if not [x for x in beers if x['beer']['bid'] == item['beer']['bid']]:
-                found = DistinctBeer.query.filter_by(untappd_bid=item['beer']['bid'], user=g.user).first()
-                beers.append({
-                    'beer': item['beer'],
-                    'consumed': bool(found)
-                })
+            if item['beer']['bid'] not in bids:
+                bids.add(item['beer']['bid'])
+                unique.append(item['beer'])
+        consumed = consumed_bids(g.user, bids)
+        beers = [{
+            'beer': beer,
+            'consumed': beer['bid'] in consumed
+        } for beer in unique]
     else:
         abort(401)
     return render_template('live_beers/view.html', beers=beers)